@@ -26,12 +26,275 @@ import mpi4py
 from mpi4py import MPI
 import os
 import sys
+import time
+import threading
 import concurrent
 from concurrent import futures
 
 from pathlib import Path
 import importlib
 import inspect
+import ast
+
+driver_modules = {}   # driver modules already imported by this process, keyed by driverabspath
+driver_stats = {
+    "imports": 0,   # number of driver imports performed by this process
+    "cached": 0     # number of driver imports avoided thanks to driver_modules
+}
+
+def import_driver(driverabspath):
+
+    """ Import the driver module of a problem once per process (and add its path to sys.path once), later calls return the cached module """
+    module = driver_modules.get(driverabspath)
+    if (module is None):
+        modulename = Path(driverabspath).stem  # get the driver name excluding all directories and extensions
+        if (driverabspath not in sys.path):
+            sys.path.append(driverabspath) # add path to sys
+        module = importlib.import_module(modulename) # import driver name as a module
+        driver_modules[driverabspath] = module
+        driver_stats["imports"] += 1
+    else:
+        driver_stats["cached"] += 1
+
+    return module
+
+schedule_stats = {}   # per phase ("search", "model", "objective"): {"busy": seconds spent computing by each worker rank, "items": number of items processed by each worker rank, "wall": seconds spent in schedule_dynamic}
+schedule_lock = threading.Lock()
+spawn_lock = threading.Lock()   # MPI.COMM_SELF.Spawn is collective over COMM_SELF, objectives trained concurrently must not spawn at the same time
+
+def schedule_dynamic(mpi_comm, items, phase):
+
+    """
+    Manager side of a dynamic work queue over the intercommunicator of a spawned group (see work_dynamic for the worker side).
+    The items are handed out one at a time to the workers as they become idle, so that a rank processing a slow item does not hold back the others.
+    Returns the results in the order of the items, each being the value returned by the worker function for that item.
+    """
+    nproc = mpi_comm.Get_remote_size()
+    results = [None] * len(items)
+    busy = [0] * nproc
+    counts = [0] * nproc
+    nsent = 0
+    active = nproc
+    status = MPI.Status()
+    t1 = time.time_ns()
+    while (active > 0):
+        (k, res, t) = mpi_comm.recv(source=MPI.ANY_SOURCE, tag=0, status=status)
+        src = status.Get_source()
+        if (k is not None):
+            results[k] = res
+            busy[src] += t
+            counts[src] += 1
+        if (nsent < len(items)):
+            mpi_comm.send((nsent, items[nsent]), dest=src, tag=0)
+            nsent += 1
+        else:
+            mpi_comm.send(None, dest=src, tag=0)
+            active -= 1
+    t2 = time.time_ns()
+
+    with schedule_lock:
+        phase_stats = schedule_stats.setdefault(phase, {"busy": [], "items": [], "wall": 0})
+        for p in range(nproc):
+            if (p >= len(phase_stats["busy"])):
+                phase_stats["busy"].append(0)
+                phase_stats["items"].append(0)
+            phase_stats["busy"][p] += busy[p]
+            phase_stats["items"][p] += counts[p]
+        phase_stats["wall"] += (t2-t1)/1e9
+
+    return results
+
+def work_dynamic(mpi_comm, fun):
+
+    """ Worker side of schedule_dynamic: request items from the manager until the queue is empty, applying fun to each of them """
+    (k, res, t) = (None, None, 0)
+    while (True):
+        mpi_comm.send((k, res, t), dest=0, tag=0)
+        msg = mpi_comm.recv(source=0, tag=0)
+        if (msg is None):
+            break
+        (k, item) = msg
+        t1 = time.time_ns()
+        res = fun(item)
+        t2 = time.time_ns()
+        t = (t2-t1)/1e9
+
+def schedule_utilization(snapshot = None):
+
+    """ Fraction of the wall time of schedule_dynamic each worker rank spent computing, per phase, since a copy of schedule_stats taken earlier (snapshot) """
+    utilization = {}
+    with schedule_lock:
+        for (phase, phase_stats) in schedule_stats.items():
+            prev = {} if snapshot is None else snapshot.get(phase, {})
+            wall = phase_stats["wall"] - prev.get("wall", 0)
+            if (wall <= 0):
+                continue
+            busy0 = prev.get("busy", [])
+            utilization[phase] = [(phase_stats["busy"][p] - (busy0[p] if p < len(busy0) else 0)) / wall for p in range(len(phase_stats["busy"]))]
+
+    return utilization
+
+class VectorizeConstraint(ast.NodeTransformer):
+
+    """
+    Rewrites a string constraint into an expression evaluated elementwise on NumPy arrays: 'and', 'or', 'not', chained comparisons and conditional expressions become calls to np.logical_and, np.logical_or, np.logical_not and np.where.
+    Expressions whose meaning would silently change on arrays (e.g. 'is', 'in', subscripts, attributes or calls other than abs) are rejected by raising ValueError.
+    """
+
+    allowed = (ast.Expression, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Compare, ast.IfExp, ast.Name, ast.Constant, ast.Load, ast.Call,
+               ast.And, ast.Or, ast.Not, ast.USub, ast.UAdd, ast.Invert,
+               ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow, ast.LShift, ast.RShift, ast.BitOr, ast.BitXor, ast.BitAnd,
+               ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
+    def np_call(self, name, args):
+
+        return ast.Call(func = ast.Attribute(value = ast.Name(id = '_np', ctx = ast.Load()), attr = name, ctx = ast.Load()), args = args, keywords = [])
+
+    def generic_visit(self, node):
+
+        if (not isinstance(node, self.allowed)):
+            raise ValueError(f'{type(node).__name__} cannot be vectorized')
+        if (isinstance(node, ast.Call) and not (isinstance(node.func, ast.Name) and node.func.id == 'abs' and len(node.keywords) == 0)):
+            raise ValueError('only abs can be called in a vectorized constraint')
+        return super(VectorizeConstraint, self).generic_visit(node)
+
+    def visit_Call(self, node):
+
+        self.generic_visit(node)
+        return node
+
+    def visit_BoolOp(self, node):
+
+        self.generic_visit(node)
+        name = 'logical_and' if isinstance(node.op, ast.And) else 'logical_or'
+        res = node.values[0]
+        for value in node.values[1:]:
+            res = self.np_call(name, [res, value])
+        return res
+
+    def visit_UnaryOp(self, node):
+
+        self.generic_visit(node)
+        if (isinstance(node.op, ast.Not)):
+            return self.np_call('logical_not', [node.operand])
+        return node
+
+    def visit_Compare(self, node):
+
+        self.generic_visit(node)
+        res = None
+        left = node.left
+        for (op, right) in zip(node.ops, node.comparators):
+            term = ast.Compare(left = left, ops = [op], comparators = [right])
+            res = term if res is None else self.np_call('logical_and', [res, term])
+            left = right
+        return res
+
+    def visit_IfExp(self, node):
+
+        self.generic_visit(node)
+        return self.np_call('where', [node.test, node.body, node.orelse])
+
+class CompiledConstraints(object):
+
+    """
+    The constraints of a problem, prepared once instead of at every evaluation:
+    string constraints are compiled into code objects, and when possible into vectorized NumPy predicates (see VectorizeConstraint),
+    callable constraints are resolved once (from the driver module if any) together with the names of their parameters.
+    """
+
+    def __init__(self, problem):
+
+        self.constraints = []   # list of (cstname, code, vcode, func, params) in the order of problem.constraints
+        for (cstname, cst) in problem.constraints.items():
+            if (isinstance(cst, str)):
+                code = compile(cst, f'<constraint {cstname}>', 'eval')
+                try:
+                    tree = VectorizeConstraint().visit(ast.parse(cst, mode = 'eval'))
+                    vcode = compile(ast.fix_missing_locations(tree), f'<vectorized constraint {cstname}>', 'eval')
+                except (ValueError, SyntaxError):
+                    vcode = None
+                self.constraints.append((cstname, code, vcode, None, None))
+            else:
+                func = cst
+                if(hasattr(problem, 'driverabspath')): # differentiate between Problem and TuningProblem
+                    if(problem.driverabspath is not None):
+                        func = getattr(import_driver(problem.driverabspath), cstname)
+                    else:
+                        raise Exception('the driverabspath is required for the constraints')
+                self.constraints.append((cstname, None, None, func, set(inspect.signature(func).parameters)))
+
+    @staticmethod
+    def column(values):
+
+        """ 1D array of the values of one parameter for evaluate_batch: integers are kept as Python integers (object array) so that the arithmetic of the constraints cannot overflow """
+        if (all(isinstance(v, (int, np.integer)) and not isinstance(v, bool) for v in values)):
+            return np.array([int(v) for v in values], dtype = object)
+        return np.array(values)
+
+    def evaluate_one(self, constraint, point, inputs_only):
+
+        (cstname, code, vcode, func, params) = constraint
+        if (code is not None):
+            try:
+                # {} has to be the global argument to eval
+                # and point the local one, otherwise,
+                # point will be corrupted / updated by eval
+                return eval(code, {}, point)
+            except Exception as inst:
+                if (inputs_only and isinstance(inst, NameError)):
+                    return True
+                else:
+                    raise Exception(f"Unexpected exception '{inst}' was raised while evaluating constraint '{cstname}'. Correct this constraint before calling the tuner again.")
+        else:
+            try:
+                kwargs2 = {varname: point[varname] for varname in point if varname in params}
+                return func(**kwargs2)
+            except Exception as inst:
+                if (isinstance(inst, TypeError)):
+                    lst = inst.__str__().split()
+                    if (len(lst) >= 5 and lst[1] == 'missing' and lst[3] == 'required' and lst[4] == 'positional'):
+                        return True
+                    else:
+                        raise Exception(f"Unexpected exception '{inst}' was raised while evaluating constraint '{cstname}'. Correct this constraint before calling the tuner again.")
+                else:
+                    raise Exception(f"Unexpected exception '{inst}' was raised while evaluating constraint '{cstname}'. Correct this constraint before calling the tuner again.")
+
+    def evaluate(self, point, inputs_only = False):
+
+        cond = True
+        for constraint in self.constraints:
+            cond = self.evaluate_one(constraint, point, inputs_only)
+            if (not cond):
+                break
+
+        return cond
+
+    def evaluate_batch(self, columns, n, inputs_only = False):
+
+        """
+        Evaluate the constraints on n points at once: the values of columns that are NumPy arrays hold one element per point, the other values are shared by all the points.
+        Every constraint is only evaluated on the points satisfying the previous ones, as the sequential evaluation does, vectorized when possible and point by point otherwise.
+        Returns a boolean array of size n.
+        """
+        cond = np.ones(n, dtype = bool)
+        for constraint in self.constraints:
+            idx = np.nonzero(cond)[0]
+            if (len(idx) == 0):
+                break
+            res = None
+            if (constraint[2] is not None):
+                local = {key: (value[idx] if isinstance(value, np.ndarray) else value) for (key, value) in columns.items()}
+                try:
+                    with np.errstate(divide = 'raise', invalid = 'raise'):   # a division by zero or nan would not raise on arrays (nor would it in an untaken branch of np.where): leave such points to the sequential semantics
+                        res = np.broadcast_to(np.asarray(eval(constraint[2], {'_np': np}, local)).astype(bool), (len(idx),))
+                except Exception:
+                    res = None   # e.g. a builtin not applying to arrays or a FloatingPointError, the point by point evaluation raises the proper exceptions
+            if (res is None):
+                res = np.array([bool(self.evaluate_one(constraint, {key: (value[i] if isinstance(value, np.ndarray) else value) for (key, value) in columns.items()}, inputs_only)) for i in idx], dtype = bool)
+            cond[idx] = res
+
+        return cond
 
 class Computer(object):
 
@@ -43,6 +306,22 @@ class Computer(object):
         if (hosts != None and nodes != len(hosts)):
             raise Exception('The number of elements in "hosts" does not match with the number of "nodes"')
 
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['compiled_constraints'] = {}   # code objects are not picklable, they are compiled again where needed
+        return state
+
+    def compile_constraints(self, problem):
+
+        if (not hasattr(self, 'compiled_constraints')):
+            self.compiled_constraints = {}
+        key = id(problem)
+        if (key not in self.compiled_constraints or self.compiled_constraints[key][0] is not problem):
+            self.compiled_constraints[key] = (problem, CompiledConstraints(problem))   # the reference to problem keeps its id from being reused
+
+        return self.compiled_constraints[key][1]
+
     def evaluate_constraints(self, problem, point : Collection, inputs_only : bool = False, **kwargs):  # point is in the original spaces
 
 #       kwargs['constraints_evaluation_parallelism']
@@ -50,48 +329,17 @@ class Computer(object):
         # points can be either a dict or a list of dicts on which to iterate
         if(problem.constants is not None):
             point.update(problem.constants)
-        cond = True
-        for (cstname, cst) in problem.constraints.items():
-            if (isinstance(cst, str)):
-                try:
-                    # {} has to be the global argument to eval
-                    # and point the local one, otherwise,
-                    # point will be corrupted / updated by eval
-                    cond = eval(cst, {}, point)
-                except Exception as inst:
-                    if (inputs_only and isinstance(inst, NameError)):
-                        pass
-                    else:
-                        raise Exception(f"Unexpected exception '{inst}' was raised while evaluating constraint '{cstname}'. Correct this constraint before calling the tuner again.")
-            else:
-                try:
-                    if(hasattr(problem, 'driverabspath')): # differentiate between Problem and TuningProblem 
-                        if(problem.driverabspath is not None):
-                            modulename = Path(problem.driverabspath).stem  # get the driver name excluding all directories and extensions
-                            sys.path.append(problem.driverabspath) # add path to sys
-                            module = importlib.import_module(modulename) # import driver name as a module
-                            cst = getattr(module, cstname)
-                        else:
-                            raise Exception('the driverabspath is required for the constraints')        
-                    kwargs2 = {}
-                    sig = inspect.signature(cst)
-                    for varname in point:
-                        if (varname in sig.parameters):
-                            kwargs2[varname] = point[varname]              
-                    cond = cst(**kwargs2)
-                except Exception as inst:
-                    if (isinstance(inst, TypeError)):
-                        lst = inst.__str__().split()
-                        if (len(lst) >= 5 and lst[1] == 'missing' and lst[3] == 'required' and lst[4] == 'positional'):
-                            pass
-                        else:
-                            raise Exception(f"Unexpected exception '{inst}' was raised while evaluating constraint '{cstname}'. Correct this constraint before calling the tuner again.")
-                    else:
-                        raise Exception(f"Unexpected exception '{inst}' was raised while evaluating constraint '{cstname}'. Correct this constraint before calling the tuner again.")
-            if (not cond):
-                break
 
-        return cond
+        return self.compile_constraints(problem).evaluate(point, inputs_only = inputs_only)
+
+    def evaluate_constraints_batch(self, problem, columns : dict, n : int, inputs_only : bool = False, **kwargs):  # columns are in the original spaces
+
+        """ Evaluate the constraints on n points at once, see CompiledConstraints.evaluate_batch, and return a boolean array of size n """
+        if(problem.constants is not None):
+            columns = dict(columns)
+            columns.update(problem.constants)
+
+        return self.compile_constraints(problem).evaluate_batch(columns, n, inputs_only = inputs_only)
 
 
     def evaluate_objective(self, problem : Problem, I : np.ndarray = None, P : Collection[np.ndarray] = None, D: Collection[dict] = None, history_db : HistoryDB = None, options: dict=None):  # P and I are in the normalized space
@@ -120,6 +368,9 @@ class Computer(object):
                         tuning_parameter = P[i],\
                         evaluation_result = tmp)
 
+        if history_db is not None:   # iteration boundary: the evaluations of all the tasks are written in one batch, off the critical path
+            history_db.flush()
+
         if(options['RCI_mode']==True):
             print('RCI: GPTune returns\n')
             exit()
@@ -129,9 +380,7 @@ class Computer(object):
     def evaluate_objective_onetask(self, problem : Problem, pids : Collection[int] = None, i_am_manager : bool = True, I_orig: Collection=None, P2 : np.ndarray = None, D2 : dict=None, options:dict=None):  # P2 is in the normalized space
 
         if(problem.driverabspath is not None and options['distributed_memory_parallelism']):
-            modulename = Path(problem.driverabspath).stem  # get the driver name excluding all directories and extensions
-            sys.path.append(problem.driverabspath) # add path to sys
-            module = importlib.import_module(modulename) # import driver name as a module
+            module = import_driver(problem.driverabspath)
             # func = getattr(module, funcName)
         else:
             module =problem
@@ -153,21 +402,12 @@ class Computer(object):
             kwargs_tmp = options
             if "mpi_comm" in kwargs_tmp:
                 del kwargs_tmp["mpi_comm"]   # mpi_comm is not picklable
-            _ = mpi_comm.bcast((self, problem,P2, D2, I_orig, pids, kwargs_tmp), root=mpi4py.MPI.ROOT)
+            _ = mpi_comm.bcast((self, problem,P2, D2, I_orig, kwargs_tmp), root=mpi4py.MPI.ROOT)
 
-            tmpdata = mpi_comm.gather(None, root=mpi4py.MPI.ROOT)
+            tmpdata = schedule_dynamic(mpi_comm, pids, "objective")   # the samples are handed out one at a time, as the application runs may have very different durations
             mpi_comm.Disconnect()
-
-            # reordering is needed as tmpdata[p] stores p, p+nproc, p+2nproc, ...
-            Otmp=[]
-            offset=[0] * (nproc+1)
-            for p in range(int(nproc)):
-                Otmp = Otmp + tmpdata[p]
-                offset[p+1]=offset[p]+len(tmpdata[p])
-            for it in range(len(tmpdata[0])):
-                for p in range(int(nproc)):
-                    if(len(O2)<len(P2)):
-                        O2.append(Otmp[offset[p]+it])
+            for res in tmpdata:
+                O2 = O2 + res
 
         elif (options['shared_memory_parallelism'] and options['objective_evaluation_parallelism']):
             with concurrent.futures.ThreadPoolExecutor(max_workers = options['objective_multisample_threads']) as executor:
@@ -217,7 +457,8 @@ class Computer(object):
         info.Set('npernode','%d'%(npernodes))  # YL: npernode is deprecated in openmpi 4.0, but no other parameter (e.g. 'map-by') works
 
 
-        comm = MPI.COMM_SELF.Spawn(sys.executable, args=executable, maxprocs=nproc,info=info)#, info=mpi_info).Merge()# process_rank = comm.Get_rank()
+        with spawn_lock:
+            comm = MPI.COMM_SELF.Spawn(sys.executable, args=executable, maxprocs=nproc,info=info)#, info=mpi_info).Merge()# process_rank = comm.Get_rank()
         # process_rank = comm.Get_rank()
         # process_count = comm.Get_size()
         # process_host = MPI.Get_processor_name()
@@ -237,8 +478,6 @@ if __name__ == '__main__':
     mpi_comm = MPI.Comm.Get_parent()
     mpi_rank = mpi_comm.Get_rank()
     mpi_size = mpi_comm.Get_size()
-    (computer, problem,P2, D2, I_orig, pids, kwargs) = mpi_comm.bcast(None, root=0)
-    pids_loc = pids[mpi_rank:len(pids):mpi_size]
-    tmpdata = computer.evaluate_objective_onetask(problem, pids_loc, False, I_orig, P2, D2, kwargs)
-    res = mpi_comm.gather(tmpdata, root=0)
+    (computer, problem,P2, D2, I_orig, kwargs) = mpi_comm.bcast(None, root=0)
+    work_dynamic(mpi_comm, lambda pid: computer.evaluate_objective_onetask(problem, [pid], False, I_orig, P2, D2, kwargs))
     mpi_comm.Disconnect()
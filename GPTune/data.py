@@ -89,6 +89,31 @@ class Data(object):
         else:
             return len(self.I)
 
+    def view(self, objective : int = None):
+
+        """ Data sharing the arrays of self, without copying them, and with only objective column objective of O (kept 2D) if objective is given. The lists are new, so that their elements can be replaced without modifying self. """
+
+        P = self.P
+        O = self.O
+        if (objective is not None and O is not None):
+            O = [y[:,objective:objective+1] for y in O]
+
+        return Data(self.problem, I = self.I, P = None if P is None else list(P), O = None if O is None else list(O), D = self.D)
+
+    def original_parameters(self, cache : Collection = None):
+
+        """ P in the original space, as a list of (list of lists). cache is a previous result for a prefix of the samples of every task: only the samples added since then are inverse-transformed. The samples are shared with cache: copy them before handing them out for modification. """
+
+        POrig = []
+        for i in range(len(self.P)):
+            prev = [] if (cache is None or i >= len(cache)) else cache[i]
+            if (len(prev) < len(self.P[i])):
+                POrig.append(prev + self.problem.PS.inverse_transform(self.P[i][len(prev):]))
+            else:
+                POrig.append(prev)
+
+        return POrig
+
     def check_inputs(self, I: np.ndarray) -> bool:
 
         cond = True
@@ -18,11 +18,13 @@
 import copy
 import functools
 import time
+import concurrent
+from concurrent import futures
 
 from autotune.problem import TuningProblem
 
 from problem import Problem
-from computer import Computer
+from computer import Computer, driver_stats, schedule_stats, schedule_utilization
 from options import Options
 from data import *
 from historydb import *
@@ -64,6 +66,126 @@ class GPTune(object):
             options = Options()
         self.options  = options
         self.history_db = HistoryDB()
+        self.lcm_pool = None   # LCM worker processes kept alive across all model trainings of this instance
+        self.search_pool = None   # search worker processes kept alive across all searches of this instance
+        self.model_pool = None   # model restart worker processes kept alive across all distributed model trainings of this instance
+        self.pool_users = []   # modelers and searchers given the pools above, detached from them by close()
+
+    def attach_lcm_pool(self, modelers, kwargs):
+
+        """ Let the Model_LCM modelers reuse the LCM worker processes of this GPTune instance """
+        if (kwargs["model_class"] == "Model_LCM" and kwargs["RCI_mode"] is False):
+            if (self.lcm_pool is None):
+                from lcm import LCM_WorkerPool
+                self.lcm_pool = LCM_WorkerPool(self.computer)
+            if (kwargs["distributed_memory_parallelism"] and self.model_pool is None):
+                self.model_pool = ModelWorkerPool(self.computer)
+            for modeler in modelers:
+                modeler.lcm_pool = self.lcm_pool
+                modeler.model_pool = self.model_pool
+                self.pool_users.append(modeler)
+
+    def attach_search_pool(self, searcher, kwargs):
+
+        """ Let the searcher reuse the search worker processes of this GPTune instance """
+        if (kwargs["RCI_mode"] is False):
+            if (self.search_pool is None):
+                from search import SearchWorkerPool
+                self.search_pool = SearchWorkerPool(self.computer)
+            searcher.pool = self.search_pool
+            self.pool_users.append(searcher)
+
+    def search_pool_stats(self):
+
+        if (self.search_pool is None):
+            return 0
+        return self.search_pool.stats["spawn_time"]
+
+    def lcm_pool_stats(self):
+
+        (spawn, compute) = (0, 0)
+        if (self.lcm_pool is not None):
+            spawn += self.lcm_pool.stats["spawn_time"]
+            compute += self.lcm_pool.stats["compute_time"]
+        if (self.model_pool is not None):   # restart workers and the LCM groups they keep, timed on the worker side
+            spawn += self.model_pool.stats["spawn_time"] + self.model_pool.stats["lcm_spawn_time"]
+            compute += self.model_pool.stats["lcm_compute_time"]
+        return (spawn, compute)
+
+    def performance_model_features(self, cache = None, **kwargs):
+
+        """
+        Outputs of the performance models (problem.models) for the samples of self.data, as one 2D array per task with one row per sample.
+        cache is a previous result for a prefix of the samples of every task: only the samples added since then are evaluated.
+        With options['model_features_vectorized'], problem.models is called once per task with the tuning parameters as 1D arrays (one element per sample) and the task parameters, task dictionary and constants as scalars, and returns one row per sample.
+        """
+        features = []
+        for i in range(len(self.data.P)):
+            prev = None if (cache is None or i >= len(cache)) else cache[i]
+            nprev = 0 if prev is None else prev.shape[0]
+            nnew = len(self.data.P[i]) - nprev
+            if (nnew <= 0):
+                features.append(prev)
+                continue
+            I_orig = self.problem.IS.inverse_transform(np.array(self.data.I[i], ndmin=2))[0]
+            points1 = {self.problem.IS[k].name: I_orig[k] for k in range(self.problem.DI)}
+            points1.update(self.data.D[i])
+            if(self.problem.constants is not None):
+                points1.update(self.problem.constants)
+            x_orig = self.problem.PS.inverse_transform(np.array(self.data.P[i][nprev:], ndmin=2))   # one call for all the new samples
+            if (kwargs['model_features_vectorized']):
+                points = {self.problem.PS[k].name: np.array([x[k] for x in x_orig]) for k in range(self.problem.DP)}
+                points.update(points1)
+                modeldata = np.array(self.problem.models(points)).reshape((nnew, -1))
+            else:
+                modeldata = []
+                for x in x_orig:
+                    points = {self.problem.PS[k].name: x[k] for k in range(self.problem.DP)}
+                    points.update(points1)
+                    modeldata.append(self.problem.models(points))
+                modeldata = np.array(modeldata).reshape((nnew, -1))
+            features.append(modeldata if prev is None else np.vstack((prev, modeldata)))
+
+        return features
+
+    def map_objectives(self, fun, kwargs):
+
+        """ Apply fun to every objective index, training up to options['model_objective_threads'] objectives concurrently, and return the results in objective order """
+        nthreads = min(self.problem.DO, kwargs['model_objective_threads'])
+        if (nthreads > 1):
+            with concurrent.futures.ThreadPoolExecutor(max_workers = nthreads) as executor:
+                return list(executor.map(fun, range(self.problem.DO)))
+        else:
+            return list(map(fun, range(self.problem.DO)))
+
+    def close(self):
+
+        """ Shut down the worker processes kept alive by this GPTune instance, a later MLA call spawns new ones """
+        for user in self.pool_users:
+            if (hasattr(user, 'pool')):
+                user.pool = None
+            else:
+                user.lcm_pool = None
+                user.model_pool = None
+        self.pool_users = []
+        if (self.lcm_pool is not None):
+            self.lcm_pool.shutdown()
+            self.lcm_pool = None
+        if (self.search_pool is not None):
+            self.search_pool.shutdown()
+            self.search_pool = None
+        if (self.model_pool is not None):
+            self.model_pool.shutdown()
+            self.model_pool = None
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *args):
+
+        self.close()
+        return False
 
     def MLA_LoadModel(self, NS = 0, Igiven = None, method = "maxevals", update = 0, model_uids = None, **kwargs):
         print('\n\n\n------Starting MLA with Trained Model for %d tasks and %d samples each '%(len(Igiven),NS))
@@ -72,12 +194,19 @@ class GPTune(object):
             "time_fun": 0,
             "time_search": 0,
             "time_model": 0,
+            "time_model_spawn": 0,
+            "time_model_compute": 0,
+            "time_search_spawn": 0,
             "modeling_time":[],
             "modeling_iteration":[]
         }
         time_fun=0
         time_search=0
         time_model=0
+        (spawn0, compute0) = self.lcm_pool_stats()
+        search_spawn0 = self.search_pool_stats()
+        cached0 = driver_stats["cached"]   # driver imports avoided by this process, see computer.import_driver
+        schedule0 = copy.deepcopy(schedule_stats)   # work handed out to the spawned worker ranks, see computer.schedule_dynamic
 
         """ Load history function evaluation data """
         self.history_db.load_history_func_eval(self.data, self.problem, Igiven)
@@ -94,8 +223,7 @@ class GPTune(object):
 
         t3 = time.time_ns()
 
-        options1 = copy.deepcopy(self.options)
-        kwargs.update(options1)
+        kwargs.update(self.options)   # the option values are not modified, no need to copy them
 
         """ Multi-task Learning Autotuning """
         if(Igiven is not None and self.data.I is None):  # building the MLA model for each of the given tasks
@@ -123,7 +251,8 @@ class GPTune(object):
         if (self.data.O is not None and len(self.data.O) !=len(self.data.I)):
             raise Exception("len(self.data.O) !=len(self.data.I)")
 
-        modelers  = [eval(f'{kwargs["model_class"]} (problem = self.problem, computer = self.computer)')]*self.problem.DO
+        modelers  = [eval(f'{kwargs["model_class"]} (problem = self.problem, computer = self.computer)') for o in range(self.problem.DO)]
+        self.attach_lcm_pool(modelers, kwargs)
         for i in range(self.problem.DO):
             # current limitations
             # - only model LCM
@@ -152,21 +281,28 @@ class GPTune(object):
                     **kwargs)
 
         searcher = eval(f'{kwargs["search_class"]}(problem = self.problem, computer = self.computer)')
+        self.attach_search_pool(searcher, kwargs)
         model_reupdate = 0
         if update == -1: # search one sample without updating model; then search next with updating model.
             model_reupdate = -1
             update = 1
         optiter = 0
         NSmin = min(map(len, self.data.P))
+        POrig = None   # self.data.P in the original space, extended with the new samples of every iteration
+        features = None   # outputs of the performance models for self.data.P, extended with the new samples of every iteration
         while NSmin<NS:# YL: each iteration adds 1 (if single objective) or at most kwargs["search_more_samples"] (if multi-objective) sample until total #sample reaches NS
 
             if(self.problem.models_update is not None):
                 ########## denormalize the data as the user always work in the original space
-                tmpdata = copy.deepcopy(self.data)
+                tmpdata = self.data.view()
                 if tmpdata.I is not None:    # from 2D numpy array to a list of lists
                     tmpdata.I = self.problem.IS.inverse_transform(tmpdata.I)
-                if tmpdata.P is not None:    # from a collection of 2D numpy arrays to a list of (list of lists)
-                    tmpdata.P = [self.problem.PS.inverse_transform(x) for x in tmpdata.P]
+                if tmpdata.P is not None:    # from a collection of 2D numpy arrays to a list of (list of lists), only the new samples are inverse-transformed
+                    POrig = self.data.original_parameters(POrig)
+                    tmpdata.P = [[list(xi) for xi in x] for x in POrig]   # models_update may modify the samples in place, POrig is kept for the next iteration
+                if tmpdata.O is not None:    # nor may it modify the objectives and constants of self.data in place
+                    tmpdata.O = [np.copy(y) for y in tmpdata.O]
+                tmpdata.D = copy.deepcopy(tmpdata.D)
                 self.problem.models_update(tmpdata)
                 self.data.D = tmpdata.D
 
@@ -176,36 +312,34 @@ class GPTune(object):
             optiter = optiter + 1
             model_reupdate = model_reupdate + 1
             t1 = time.time_ns()
-            for o in range(self.problem.DO):
-                tmpdata = copy.deepcopy(self.data)
-                tmpdata.O = [copy.deepcopy(self.data.O[i][:,o].reshape((-1,1))) for i in range(len(self.data.I))]
+            do_train = (model_reupdate == update)   # decided once for all the objectives
+            if(self.problem.models is not None):   # computed once for all the objectives, and only for the new samples unless models_update may have changed the models
+                features = self.performance_model_features(features if self.problem.models_update is None else None, **kwargs)
+            def fit(o):   # the objectives are fitted independently, possibly concurrently
+                tmpdata = self.data.view(objective = o)   # shares the arrays of self.data, which are never modified in place
                 if(self.problem.models is not None):
                     for i in range(len(tmpdata.P)):
-                        points0 = tmpdata.D[i]
-                        t = tmpdata.I[i]
-                        I_orig = self.problem.IS.inverse_transform(np.array(t, ndmin=2))[0]
-                        points1 = {self.problem.IS[k].name: I_orig[k] for k in range(self.problem.DI)}
-                        modeldata=[]
-                        for p in range(len(tmpdata.P[i])):
-                            x = tmpdata.P[i][p]
-                            x_orig = self.problem.PS.inverse_transform(np.array(x, ndmin=2))[0]
-                            points = {self.problem.PS[k].name: x_orig[k] for k in range(self.problem.DP)}
-                            points.update(points1)
-                            points.update(points0)
-                            modeldata.append(self.problem.models(points))
-                        modeldata=np.array(modeldata)
-                        tmpdata.P[i] = np.hstack((tmpdata.P[i],modeldata))  # YL: here tmpdata in the normalized space, but modeldata is the in the original space
-                for i in range(len(tmpdata.P)):   # LCM requires the same number of samples per task, so use the first NSmin samples
-                    tmpdata.O[i] = tmpdata.O[i][0:NSmin,:]
-                    tmpdata.P[i] = tmpdata.P[i][0:NSmin,:]
-
-                if model_reupdate == update:
+                        tmpdata.P[i] = np.hstack((tmpdata.P[i],features[i]))  # YL: here tmpdata in the normalized space, but modeldata is the in the original space
+
+                if (do_train):
                     # print(tmpdata.P[0])
                     #print ("[bestxopt]: len: " + str(len(bestxopt)) + " val: " + str(bestxopt))
                     if (kwargs["model_class"] == "Model_LCM"):
+                        return modelers[o].train(data = tmpdata, **kwargs)
+                    else:
+                        modelers[o].train(data = tmpdata, **kwargs)
+                else:
+                    if (kwargs["model_class"] == "Model_LCM"):
+                        if (kwargs["model_incremental"]):   # add the new samples to the model without changing the hyperparameters
+                            modelers[o].update(tmpdata, do_train = False, **kwargs)
+                return None
+
+            results = self.map_objectives(fit, kwargs)
+            if (do_train):
+                if (kwargs["model_class"] == "Model_LCM"):   # the history database is updated after all the fits have joined
+                    for o in range(self.problem.DO):
                         (bestxopt, neg_log_marginal_likelihood,
-                                gradients, iteration) = \
-                            modelers[o].train(data = tmpdata, **kwargs)
+                                gradients, iteration) = results[o]
                         self.history_db.update_model_LCM(
                                 o,
                                 self.problem,
@@ -215,13 +349,7 @@ class GPTune(object):
                                 gradients,
                                 iteration)
                         stats["modeling_iteration"][optiter-1] += iteration
-                    else:
-                        modelers[o].train(data = tmpdata, **kwargs)
-                        stats["modeling_iteration"][optiter-1] += 0
-                    model_reupdate = 0
-                else:
-                    if (kwargs["model_class"] == "Model_LCM"):
-                        stats["modeling_iteration"][optiter-1] += 0
+                model_reupdate = 0
 
             t2 = time.time_ns()
             stats["modeling_time"].append((t2-t1)/1e9)
@@ -261,8 +389,16 @@ class GPTune(object):
         stats['time_fun'] = time_fun
         stats['time_model'] = time_model
         stats['time_search'] = time_search
+        (spawn1, compute1) = self.lcm_pool_stats()
+        stats['time_model_spawn'] = spawn1 - spawn0
+        stats['time_model_compute'] = compute1 - compute0
+        stats['time_search_spawn'] = self.search_pool_stats() - search_spawn0
+        stats['driver_imports_avoided'] = driver_stats["cached"] - cached0
+        stats['rank_utilization'] = schedule_utilization(schedule0)   # per phase, fraction of the time each worker rank spent computing
+        self.history_db.flush(wait = True)   # the history database is complete when MLA returns
+        stats['history_db_writes'] = self.history_db.write_metrics()   # queue depth and flush latencies of the background writer
 
-        return (copy.deepcopy(self.data), modelers, stats)
+        return (self.data.view(), modelers, stats)
 
     def MLA_HistoryDB(self, NS, NS1 = None, NI = None, Igiven = None, **kwargs):
         print('\n\n\n------Starting MLA with HistoryDB with %d tasks and %d samples each '%(NI,NS))
@@ -272,6 +408,9 @@ class GPTune(object):
             "time_fun": 0,
             "time_search": 0,
             "time_model": 0,
+            "time_model_spawn": 0,
+            "time_model_compute": 0,
+            "time_search_spawn": 0,
             "modeling_time":[],
             "modeling_iteration":[]
         }
@@ -279,6 +418,10 @@ class GPTune(object):
         time_sample_init=0
         time_search=0
         time_model=0
+        (spawn0, compute0) = self.lcm_pool_stats()
+        search_spawn0 = self.search_pool_stats()
+        cached0 = driver_stats["cached"]   # driver imports avoided by this process, see computer.import_driver
+        schedule0 = copy.deepcopy(schedule_stats)   # work handed out to the spawned worker ranks, see computer.schedule_dynamic
 
         """ Load history function evaluation data """
         self.history_db.load_history_func_eval(self.data, self.problem, Igiven)
@@ -304,8 +447,7 @@ class GPTune(object):
 
         t1 = time.time_ns()
 
-        options1 = copy.deepcopy(self.options)
-        kwargs.update(options1)
+        kwargs.update(self.options)   # the option values are not modified, no need to copy them
 
         """ Multi-task Learning Autotuning """
 
@@ -378,19 +520,27 @@ class GPTune(object):
         t2 = time.time_ns()
         time_fun = time_fun + (t2-t1)/1e9
 
-        modelers  = [eval(f'{kwargs["model_class"]} (problem = self.problem, computer = self.computer)')]*self.problem.DO
+        modelers  = [eval(f'{kwargs["model_class"]} (problem = self.problem, computer = self.computer)') for o in range(self.problem.DO)]
+        self.attach_lcm_pool(modelers, kwargs)
         searcher = eval(f'{kwargs["search_class"]}(problem = self.problem, computer = self.computer)')
+        self.attach_search_pool(searcher, kwargs)
         optiter = 0
         NSmin = min(map(len, self.data.P))
+        POrig = None   # self.data.P in the original space, extended with the new samples of every iteration
+        features = None   # outputs of the performance models for self.data.P, extended with the new samples of every iteration
         while NSmin<NS:# YL: each iteration adds 1 (if single objective) or at most kwargs["search_more_samples"] (if multi-objective) sample until total #sample reaches NS
 
             if(self.problem.models_update is not None):
                 ########## denormalize the data as the user always work in the original space
-                tmpdata = copy.deepcopy(self.data)
+                tmpdata = self.data.view()
                 if tmpdata.I is not None:    # from 2D numpy array to a list of lists
                     tmpdata.I = self.problem.IS.inverse_transform(tmpdata.I)
-                if tmpdata.P is not None:    # from a collection of 2D numpy arrays to a list of (list of lists)
-                    tmpdata.P = [self.problem.PS.inverse_transform(x) for x in tmpdata.P]
+                if tmpdata.P is not None:    # from a collection of 2D numpy arrays to a list of (list of lists), only the new samples are inverse-transformed
+                    POrig = self.data.original_parameters(POrig)
+                    tmpdata.P = [[list(xi) for xi in x] for x in POrig]   # models_update may modify the samples in place, POrig is kept for the next iteration
+                if tmpdata.O is not None:    # nor may it modify the objectives and constants of self.data in place
+                    tmpdata.O = [np.copy(y) for y in tmpdata.O]
+                tmpdata.D = copy.deepcopy(tmpdata.D)
                 self.problem.models_update(tmpdata)
                 self.data.D = tmpdata.D
 
@@ -399,36 +549,26 @@ class GPTune(object):
             stats["modeling_iteration"].append(0)
             optiter = optiter + 1
             t1 = time.time_ns()
-            for o in range(self.problem.DO):
-                tmpdata = copy.deepcopy(self.data)
-                tmpdata.O = [copy.deepcopy(self.data.O[i][:,o].reshape((-1,1))) for i in range(len(self.data.I))]
+            if(self.problem.models is not None):   # computed once for all the objectives, and only for the new samples unless models_update may have changed the models
+                features = self.performance_model_features(features if self.problem.models_update is None else None, **kwargs)
+            def fit(o):   # the objectives are fitted independently, possibly concurrently
+                tmpdata = self.data.view(objective = o)   # shares the arrays of self.data, which are never modified in place
                 if(self.problem.models is not None):
                     for i in range(len(tmpdata.P)):
-                        points0 = tmpdata.D[i]
-                        t = tmpdata.I[i]
-                        I_orig = self.problem.IS.inverse_transform(np.array(t, ndmin=2))[0]
-                        points1 = {self.problem.IS[k].name: I_orig[k] for k in range(self.problem.DI)}
-                        modeldata=[]
-                        for p in range(len(tmpdata.P[i])):
-                            x = tmpdata.P[i][p]
-                            x_orig = self.problem.PS.inverse_transform(np.array(x, ndmin=2))[0]
-                            points = {self.problem.PS[k].name: x_orig[k] for k in range(self.problem.DP)}
-                            points.update(points1)
-                            points.update(points0)
-                            if(self.problem.constants is not None):
-                                points.update(self.problem.constants)
-                            modeldata.append(self.problem.models(points))
-                        modeldata=np.array(modeldata)
-                        tmpdata.P[i] = np.hstack((tmpdata.P[i],modeldata))  # YL: here tmpdata in the normalized space, but modeldata is the in the original space
-                for i in range(len(tmpdata.P)):   # LCM requires the same number of samples per task, so use the first NSmin samples
-                    tmpdata.O[i] = tmpdata.O[i][0:NSmin,:]
-                    tmpdata.P[i] = tmpdata.P[i][0:NSmin,:]
+                        tmpdata.P[i] = np.hstack((tmpdata.P[i],features[i]))  # YL: here tmpdata in the normalized space, but modeldata is the in the original space
                 # print(tmpdata.P[0])
                 #print ("[bestxopt]: len: " + str(len(bestxopt)) + " val: " + str(bestxopt))
+                if (kwargs["model_class"] == "Model_LCM"):
+                    return modelers[o].train(data = tmpdata, **kwargs)
+                else:
+                    modelers[o].train(data = tmpdata, **kwargs)
+                    return None
+
+            results = self.map_objectives(fit, kwargs)
+            for o in range(self.problem.DO):   # the history database is updated after all the fits have joined
                 if (kwargs["model_class"] == "Model_LCM"):
                     (bestxopt, neg_log_marginal_likelihood,
-                            gradients, iteration) = \
-                        modelers[o].train(data = tmpdata, **kwargs)
+                            gradients, iteration) = results[o]
                     self.history_db.update_model_LCM(
                             o,
                             self.problem,
@@ -438,9 +578,7 @@ class GPTune(object):
                             gradients,
                             iteration)
                     stats["modeling_iteration"][optiter-1] += iteration
-                else:
-                    modelers[o].train(data = tmpdata, **kwargs)
-                
+
                 if self.options['verbose'] == True and self.options['model_class'] == 'Model_LCM' and len(self.data.I)>1:
                     C = modelers[o].M.kern.get_correlation_metric()
                     print("The correlation matrix C is \n", C)
@@ -487,8 +625,16 @@ class GPTune(object):
         stats['time_model'] = time_model
         stats['time_search'] = time_search
         stats['time_sample_init'] = time_sample_init
+        (spawn1, compute1) = self.lcm_pool_stats()
+        stats['time_model_spawn'] = spawn1 - spawn0
+        stats['time_model_compute'] = compute1 - compute0
+        stats['time_search_spawn'] = self.search_pool_stats() - search_spawn0
+        stats['driver_imports_avoided'] = driver_stats["cached"] - cached0
+        stats['rank_utilization'] = schedule_utilization(schedule0)   # per phase, fraction of the time each worker rank spent computing
+        self.history_db.flush(wait = True)   # the history database is complete when MLA returns
+        stats['history_db_writes'] = self.history_db.write_metrics()   # queue depth and flush latencies of the background writer
 
-        return (copy.deepcopy(self.data), modelers, stats)
+        return (self.data.view(), modelers, stats)
 
     def MLA(self, NS, NS1 = None, NI = None, Igiven = None, **kwargs):
         if self.history_db.history_db is True:
@@ -967,6 +1113,7 @@ class GPTune_MB(object):
                 gt = GPTune(self.tp, computer=self.computer,
                             data=data, options=self.options)
                 (data, _, stats0) = gt.MLA(NS=ntotal, Igiven=newtasks, NI=len(newtasks), NS1=min(self.NSs))
+                gt.close()
                 data.P = [x[-ns:] for x in data.P]
                 data.O = [x[-ns:] for x in data.O]
                 data1.I += data.I[0:len(Igiven)]
@@ -1045,6 +1192,7 @@ class GPTune_MB(object):
                     
                     
                     gt.history_db.load_history_func_eval(newdata, gt.problem, temp_I)
+                    gt.close()
 
 
                     t1 = time.time_ns()
@@ -1068,6 +1216,7 @@ class GPTune_MB(object):
                         gt.data.I = gt.problem.IS.transform(gt.data.I)
                         newdata.O = gt.computer.evaluate_objective(gt.problem, gt.data.I, gt.data.P, gt.data.D, gt.history_db, options = kwargs)
                         newdata.P = [gt.problem.PS.inverse_transform(x) for x in newdata.P]
+                        gt.close()
 
                     else:
                         # print('done: what do you do')
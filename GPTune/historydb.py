@@ -25,6 +25,11 @@ from autotune.space import *
 from autotune.problem import TuningProblem
 import uuid
 import time
+import atexit
+import sqlite3
+import fcntl
+import threading
+import queue
 
 def GetMachineConfiguration(meta_description_path = "./.gptune/meta.json"):
     import ast
@@ -68,6 +73,101 @@ def GetMachineConfiguration(meta_description_path = "./.gptune/meta.json"):
 
     return (machine_name, processor_model, nodes, cores)
 
+fcntl_thread_locks = {}   # lock file path -> threading.Lock, see FcntlLock
+fcntl_thread_locks_lock = threading.Lock()
+
+class FcntlLock(object):
+
+    """
+    Exclusive POSIX record lock (fcntl.lockf) on a lock file; unlike flock, lockf also works on most NFS mounts.
+    lockf locks belong to the process, and closing any descriptor of the file releases them: a threading.Lock per path also serializes the HistoryDB instances and writer threads of this process.
+    """
+
+    def __init__(self, path, timeout = -1):
+
+        self.path = path
+        self.timeout = timeout   # a non-negative timeout fails immediately if the lock is taken
+        self.fd = None
+        with fcntl_thread_locks_lock:
+            self.thread_lock = fcntl_thread_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+    def __enter__(self):
+
+        if (not self.thread_lock.acquire(self.timeout < 0)):
+            raise Exception("[HistoryDB] " + self.path + " is locked by another thread")
+        try:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.lockf(self.fd, fcntl.LOCK_EX if self.timeout < 0 else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except:
+                os.close(self.fd)
+                self.fd = None
+                raise
+        except:
+            self.thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *args):
+
+        fcntl.lockf(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+        self.thread_lock.release()
+        return False
+
+class ExclusiveLock(object):
+
+    """
+    Lock held while the file path+".held", created with O_CREAT | O_EXCL, exists: the last resort on file systems without working file locks.
+    The holder touches the file every stale_time/4 seconds, however long it keeps the lock (e.g. during a compaction), so that a file not touched for stale_time seconds can only be left by a crashed process.
+    """
+
+    def __init__(self, path, timeout = -1, stale_time = 60):
+
+        self.path = path + ".held"   # the other locks leave path behind
+        self.timeout = timeout   # a non-negative timeout fails immediately if the lock is taken
+        self.stale_time = stale_time
+        self.released = None
+        self.heartbeat = None
+
+    def touch(self):
+
+        while (not self.released.wait(self.stale_time/4)):
+            try:
+                os.utime(self.path)
+            except OSError:
+                pass
+
+    def __enter__(self):
+
+        wait = 0.001
+        while True:
+            try:
+                os.close(os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+                self.released = threading.Event()
+                self.heartbeat = threading.Thread(target=self.touch, daemon=True)
+                self.heartbeat.start()
+                return self
+            except FileExistsError:
+                if self.timeout >= 0:
+                    raise
+                try:
+                    if time.time() - os.stat(self.path).st_mtime > self.stale_time:
+                        os.remove(self.path)
+                        continue
+                except OSError:
+                    continue
+                time.sleep(wait)
+                wait = min(2*wait, 0.05)
+
+    def __exit__(self, *args):
+
+        self.released.set()
+        self.heartbeat.join()
+        os.remove(self.path)
+        return False
+
 class HistoryDB(dict):
 
     def __init__(self, **kwargs):
@@ -106,12 +206,41 @@ class HistoryDB(dict):
         """ list of UIDs of function evaluation results """
         self.uids = []
 
-        """ File synchronization options """
-        self.file_synchronization_method = 'filelock'
+        """ File synchronization options: 'fcntl' -- POSIX record locks, 'filelock' -- the filelock package, 'exclusive' -- lock files created with O_EXCL (chosen by _probe_file_synchronization) """
+        self.file_synchronization_method = 'fcntl'
+        self.file_locks = {'fcntl':FcntlLock, 'filelock':FileLock, 'exclusive':ExclusiveLock}
 
         """ Process uid """
         self.process_uid = str(uuid.uuid1())
 
+        """ Append-only log: new records are appended to <problem>.jsonl instead of rewriting <problem>.json, and the log is merged into the JSON file (compaction) when it grows beyond compact_log_size bytes and at exit """
+        self.append_log = True
+        self.compact_log_size = 4*1024*1024
+        self.history_logs = set()   # JSON files whose log was written by this instance, compacted at exit
+
+        """ Asynchronous writes: update_func_eval and update_model_LCM queue their records for a background writer thread, which writes everything queued before a flush (e.g. all the evaluations of an MLA iteration) in one durable write per database """
+        self.async_write = True
+        self.write_queue_size = 1024   # updates queued before update_func_eval and update_model_LCM block on the writer
+        self.write_queue = None
+        self.writer = None
+        self.write_error = None   # exception raised in the writer thread, raised again by the next flush
+        self.write_stats = {"queue_depth_max":0, "flush_count":0, "flush_records":0, "flush_latency":0, "flush_latency_max":0}   # latencies in seconds, from the flush request to the end of the write
+        self.write_stats_lock = threading.Lock()   # write_stats and write_error are updated by the writer thread and read by the caller
+
+        """ Storage engine: 'json' -- <problem>.json (and its log), 'sqlite' -- <problem>.db, an SQLite database with indexes on the problem name, task parameters, machine and software configurations (created from <problem>.json if it exists) """
+        self.storage = 'json'
+        self.sqlite_paths = set()   # SQLite databases whose tables and indexes exist, see _sqlite_connect
+        self.task_parameter_names = None   # names of the task parameters of the problem (problem.IS), which define the task of a function evaluation
+
+        """ Parsed model data per history database, indexed by modeler, by (modeler, objective) and by uid, see _history_snapshot """
+        self.snapshots = {}
+
+        """ Results of check_load_deps per (machine configuration, software configuration) """
+        self.load_deps_cache = {}
+
+        """ Parsed history data per JSON file: {"stat": (mtime, size) of the JSON file, "data": contents merged with the log, "offset": bytes of the log already merged, "uids": uids of the records in data} """
+        self.history_cache = {}
+
         # if history database is requested by CK-GPTune
         if (os.environ.get('CKGPTUNE_HISTORY_DB') == 'yes'):
             print ("CK-GPTune History Database Init")
@@ -132,19 +261,12 @@ class HistoryDB(dict):
             self.loadable_machine_configurations = ast.literal_eval(os.environ.get('CKGPTUNE_LOADABLE_MACHINE_CONFIGURATIONS','{}'))
             self.loadable_software_configurations = ast.literal_eval(os.environ.get('CKGPTUNE_LOADABLE_SOFTWARE_CONFIGURATIONS', '{}'))
 
-            os.system("mkdir -p ./gptune.db")
+            os.makedirs("./gptune.db", exist_ok=True)
             self.history_db_path = "./gptune.db"
 
             if (os.environ.get('CKGPTUNE_LOAD_MODEL') == 'yes'):
                 self.load_model = True
-            try:
-                with FileLock("test.lock", timeout=0):
-                    print ("[HistoryDB] use filelock for synchronization")
-                    self.file_synchronization_method = 'filelock'
-            except:
-                print ("[HistoryDB] use rsync for synchronization")
-                self.file_synchronization_method = 'rsync'
-            os.system("rm -rf test.lock")
+            self._probe_file_synchronization()
 
         # if GPTune is called through Reverse Communication Interface
         elif os.path.exists('./.gptune/meta.json'): #or (os.environ.get('GPTUNE_RCI') == 'yes'):
@@ -161,7 +283,7 @@ class HistoryDB(dict):
                 if "history_db_path" in gptune_metadata:
                     self.history_db_path = gptune_metadata["history_db_path"]
                 else:
-                    os.system("mkdir -p ./gptune.db")
+                    os.makedirs("./gptune.db", exist_ok=True)
                     self.history_db_path = "./gptune.db"
 
                 if "machine_configuration" in gptune_metadata:
@@ -172,19 +294,362 @@ class HistoryDB(dict):
                     self.loadable_machine_configurations = gptune_metadata["loadable_machine_configurations"]
                 if "loadable_software_configurations" in gptune_metadata:
                     self.loadable_software_configurations = gptune_metadata["loadable_software_configurations"]
+                if "history_db_storage" in gptune_metadata:
+                    self.storage = gptune_metadata["history_db_storage"]
+                if "history_db_async_write" in gptune_metadata:
+                    self.async_write = gptune_metadata["history_db_async_write"]
 
-                try:
-                    with FileLock("test.lock", timeout=0):
-                        print ("[HistoryDB] use filelock for synchronization")
-                        self.file_synchronization_method = 'filelock'
-                except:
-                    print ("[HistoryDB] use rsync for synchronization")
-                    self.file_synchronization_method = 'rsync'
-                os.system("rm -rf test.lock")
+                self._probe_file_synchronization()
         else:
             self.history_db = False
 
-    def check_load_deps(self, func_eval):
+        if (self.history_db):
+            atexit.register(self.close)   # leave a complete JSON file for the tools reading it directly (e.g. the RCI scripts)
+
+    def _probe_file_synchronization(self):
+
+        """ Pick the first file synchronization method able to lock a file in history_db_path """
+        os.makedirs(self.history_db_path, exist_ok=True)
+        probe_path = os.path.join(self.history_db_path, "." + self.process_uid + ".lock")
+        for method in ('fcntl', 'filelock', 'exclusive'):
+            try:
+                with self.file_locks[method](probe_path, timeout=0):
+                    pass
+                self.file_synchronization_method = method
+                break
+            except:
+                continue
+        try:
+            os.remove(probe_path)
+        except OSError:
+            pass
+        print ("[HistoryDB] use " + self.file_synchronization_method + " for synchronization")
+
+    def _lock(self, json_data_path):
+
+        """ Lock serializing the updates of json_data_path with the configured file synchronization method """
+        return self.file_locks[self.file_synchronization_method](json_data_path+".lock")
+
+    def _write_snapshot(self, json_data_path, history_data):
+
+        """ Replace json_data_path by history_data with an atomic rename, so that readers see either the previous or the new contents, never a partially written file """
+        temp_path = json_data_path + "." + self.process_uid + ".temp"
+        with open(temp_path, "w") as f_out:
+            json.dump(history_data, f_out, indent=2)
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        os.replace(temp_path, json_data_path)
+
+    def _file_stat(self, path):
+
+        if not os.path.exists(path):
+            return (0, 0)
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def _read_snapshot(self, json_data_path):
+
+        """ Parse the JSON file json_data_path (the caller holds the file lock if any) """
+        if not os.path.exists(json_data_path):
+            return {"tuning_problem_name":self.tuning_problem_name,
+                "model_data":[],
+                "func_eval":[]}
+        with open(json_data_path, "r") as f_in:   # complete, as writers replace the file atomically
+            history_data = json.load(f_in)
+        history_data.setdefault("model_data", [])
+        history_data.setdefault("func_eval", [])
+
+        return history_data
+
+    def _load_history_data(self, json_data_path):
+
+        """ Contents of json_data_path merged with its log (the caller holds the file lock if any). The JSON file is parsed again only if it changed (e.g. compacted), and only the log records appended since the previous call are parsed. """
+        json_log_path = json_data_path + "l"
+        stat = self._file_stat(json_data_path)
+        cache = self.history_cache.get(json_data_path)
+        if (cache is None or cache["stat"] != stat or self._file_stat(json_log_path)[1] < cache["offset"]):
+            history_data = self._read_snapshot(json_data_path)
+            cache = {"stat": stat,
+                "data": history_data,
+                "offset": 0,
+                "uids": set(record.get("uid") for table in ("func_eval", "model_data") for record in history_data[table])}
+            self.history_cache[json_data_path] = cache
+
+        if os.path.exists(json_log_path):
+            with open(json_log_path, "rb") as f_in:
+                f_in.seek(cache["offset"])
+                for line in f_in:
+                    if (not line.endswith(b"\n")):   # record still being written by another process, merged by a later call
+                        break
+                    cache["offset"] += len(line)
+                    for (table, records) in json.loads(line).items():
+                        for record in records:
+                            if (record.get("uid") not in cache["uids"]):   # records already compacted into the JSON file are skipped
+                                cache["uids"].add(record.get("uid"))
+                                cache["data"][table].append(record)
+
+        return cache["data"]
+
+    def _sqlite_connect(self, json_data_path):
+
+        """ Connection to the SQLite database replacing json_data_path, created on first use with the records of json_data_path if it exists """
+        db_path = os.path.splitext(json_data_path)[0] + ".db"
+        new = not os.path.exists(db_path)
+        conn = sqlite3.connect(db_path, timeout = 600)
+        if (db_path not in self.sqlite_paths):   # once per database and instance
+            conn.execute("CREATE TABLE IF NOT EXISTS func_eval (uid TEXT PRIMARY KEY, problem TEXT, task_key TEXT, machine_key TEXT, software_key TEXT, record TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS func_eval_task ON func_eval (problem, task_key)")
+            conn.execute("CREATE INDEX IF NOT EXISTS func_eval_configuration ON func_eval (machine_key, software_key)")
+            conn.execute("CREATE TABLE IF NOT EXISTS model_data (uid TEXT PRIMARY KEY, problem TEXT, modeler TEXT, objective_id INTEGER, record TEXT)")
+            conn.execute("CREATE INDEX IF NOT EXISTS model_data_model ON model_data (problem, modeler, objective_id)")
+            if (new and os.path.exists(json_data_path)):
+                history_data = self._read_json_history_data(json_data_path)
+                self._sqlite_insert(conn, "func_eval", history_data["func_eval"])
+                self._sqlite_insert(conn, "model_data", history_data["model_data"])
+            conn.commit()
+            self.sqlite_paths.add(db_path)
+
+        return conn
+
+    def _sqlite_insert(self, conn, table, records):
+
+        if (table == "func_eval"):
+            conn.executemany("INSERT OR IGNORE INTO func_eval VALUES (?, ?, ?, ?, ?, ?)",
+                [(record["uid"], self.tuning_problem_name, self._task_key(record["task_parameter"], self.task_parameter_names),
+                  json.dumps(record["machine_configuration"], sort_keys=True), json.dumps(record["software_configuration"], sort_keys=True),
+                  json.dumps(record)) for record in records])
+        else:
+            conn.executemany("INSERT OR IGNORE INTO model_data VALUES (?, ?, ?, ?, ?)",
+                [(record["uid"], self.tuning_problem_name, record["modeler"], record["objective_id"], json.dumps(record)) for record in records])
+
+    def _history_exists(self, json_data_path):
+
+        return os.path.exists(json_data_path) or (self.storage == 'sqlite' and os.path.exists(os.path.splitext(json_data_path)[0] + ".db"))
+
+    def _snapshot_stat(self, json_data_path):
+
+        if (self.storage == 'sqlite'):
+            db_path = os.path.splitext(json_data_path)[0] + ".db"
+            if not os.path.exists(db_path):
+                self._sqlite_connect(json_data_path).close()   # created (and filled from json_data_path) before its state is recorded
+            return self._file_stat(db_path)   # rollback journal: every commit writes the database file
+        return (self._file_stat(json_data_path), self._file_stat(json_data_path + "l"))
+
+    def _history_snapshot(self, json_data_path):
+
+        """
+        Model data of the history database json_data_path, kept in memory with its indexes ("modeler", "model" by (modeler, objective) and "uid") and shared by all the query methods.
+        It is read again only when the modification time or the size of the database files changed, so consecutive queries (e.g. one per objective) neither lock nor parse the files.
+        """
+        self.flush(wait = True)   # include the records still queued by this instance
+        stat = self._snapshot_stat(json_data_path)   # taken before reading, so that a concurrent update is picked up by the next query
+        snapshot = self.snapshots.get(json_data_path)
+        if (snapshot is None or snapshot["stat"] != stat):
+            model_data = self._read_history_data(json_data_path, tables = ("model_data",))["model_data"]
+            snapshot = {"stat": stat, "model_data": model_data, "modeler": {}, "model": {}, "uid": {}}
+            for i in range(len(model_data)):
+                snapshot["modeler"].setdefault(model_data[i]["modeler"], []).append(i)
+                snapshot["model"].setdefault((model_data[i]["modeler"], model_data[i]["objective_id"]), []).append(i)
+                snapshot["uid"].setdefault(model_data[i]["uid"], i)
+            self.snapshots[json_data_path] = snapshot
+
+        return snapshot
+
+    def _read_history_data(self, json_data_path, tables = ("func_eval", "model_data")):
+
+        """ Contents of the history database json_data_path, including the records of its log; the result is shared with later calls and must not be modified. With the SQLite storage, only the given tables are read. """
+        if (self.storage == 'sqlite'):
+            conn = self._sqlite_connect(json_data_path)
+            try:
+                return {table: [json.loads(record) for (record,) in conn.execute("SELECT record FROM " + table + " WHERE problem = ? ORDER BY rowid", (self.tuning_problem_name,))] for table in tables}
+            finally:
+                conn.close()
+        return self._read_json_history_data(json_data_path)
+
+    def _read_json_history_data(self, json_data_path):
+
+        with self._lock(json_data_path):
+            return self._load_history_data(json_data_path)
+
+    def _compact_log(self, json_data_path):
+
+        """ Merge the log into the JSON file and truncate it (the caller holds the file lock) """
+        history_data = self._load_history_data(json_data_path)
+        self._write_snapshot(json_data_path, history_data)
+        open(json_data_path + "l", "w").close()
+
+    def compact_logs(self):
+
+        """ Merge the logs written by this instance into their JSON files """
+        for json_data_path in self.history_logs:
+            with self._lock(json_data_path):
+                if (self._file_stat(json_data_path + "l")[1] > 0):
+                    self._compact_log(json_data_path)
+        self.history_logs = set()
+
+    def _append_records(self, json_data_path, table_records):
+
+        """ Add the records of table_records ({"func_eval": records, "model_data": records}) to the history database json_data_path in one durable write """
+        if (self.storage == 'sqlite'):
+            conn = self._sqlite_connect(json_data_path)
+            try:
+                with conn:   # one transaction
+                    for (table, records) in table_records.items():
+                        self._sqlite_insert(conn, table, records)
+            finally:
+                conn.close()
+            return
+
+        if (self.append_log):
+            # one line per update, written with a single O_APPEND write: the cost no longer depends on the size of the database
+            line = (json.dumps(table_records) + "\n").encode()
+            with self._lock(json_data_path):
+                fd = os.open(json_data_path + "l", os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(fd, line)
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                self.history_logs.add(json_data_path)
+                if (self._file_stat(json_data_path + "l")[1] > self.compact_log_size):
+                    self._compact_log(json_data_path)
+            return
+
+        with self._lock(json_data_path):
+            json_data = self._read_snapshot(json_data_path)
+            for (table, records) in table_records.items():
+                json_data[table] += records
+            self._write_snapshot(json_data_path, json_data)
+
+    def _queue_records(self, json_data_path, table, records):
+
+        """ Hand the records over to the writer thread, or write them right away if async_write is False """
+        if (not self.async_write):
+            self._append_records(json_data_path, {table: records})
+            return
+        if (self.writer is None):
+            self.write_queue = queue.Queue(self.write_queue_size)
+            self.writer = threading.Thread(target=self._write_records, daemon=True)   # daemon: stopped by close, registered with atexit
+            self.writer.start()
+        self.write_queue.put(("records", (json_data_path, table, records)))
+        with self.write_stats_lock:
+            self.write_stats["queue_depth_max"] = max(self.write_stats["queue_depth_max"], self.write_queue.qsize())
+
+    def _write_records(self):
+
+        """ Writer thread: accumulate the queued records and write them at each flush, one write per database """
+        pending = {}   # json_data_path -> {table: records} queued since the last flush
+        while True:
+            (command, arg) = self.write_queue.get()
+            if (command == "records"):
+                (json_data_path, table, records) = arg
+                pending.setdefault(json_data_path, {}).setdefault(table, []).extend(records)
+                continue
+
+            (done, t1) = arg   # "flush" or "end"
+            num_records = 0
+            error = None
+            try:
+                for (json_data_path, table_records) in pending.items():
+                    self._append_records(json_data_path, table_records)
+                    num_records += sum(map(len, table_records.values()))
+            except Exception as e:
+                error = e
+            latency = (time.time_ns()-t1)/1e9
+            with self.write_stats_lock:
+                if (error is not None):
+                    self.write_error = error
+                self.write_stats["flush_records"] += num_records
+                if (len(pending) > 0):
+                    self.write_stats["flush_count"] += 1
+                    self.write_stats["flush_latency"] += latency
+                    self.write_stats["flush_latency_max"] = max(self.write_stats["flush_latency_max"], latency)
+            pending = {}
+            done.set()
+            if (command == "end"):
+                return
+
+    def flush(self, wait = False):
+
+        """ End the current batch of queued records: the writer thread writes them while the caller goes on, or before returning if wait is True """
+        if (self.writer is None):
+            return
+        done = threading.Event()
+        self.write_queue.put(("flush", (done, time.time_ns())))
+        if (wait):
+            done.wait()
+        with self.write_stats_lock:
+            e = self.write_error
+            self.write_error = None
+        if (e is not None):
+            raise Exception("[HistoryDB] the background write of the history database failed: " + str(e))
+
+    def write_metrics(self):
+
+        """ Current depth of the write queue and the statistics of the flushes """
+        with self.write_stats_lock:
+            metrics = dict(self.write_stats)
+        metrics["queue_depth"] = self.write_queue.qsize() if self.write_queue is not None else 0
+        return metrics
+
+    def close(self):
+
+        """ Write the queued records, stop the writer thread and merge the logs into their JSON files """
+        if (self.writer is not None):
+            done = threading.Event()
+            self.write_queue.put(("end", (done, time.time_ns())))
+            self.writer.join()
+            self.writer = None
+            if (self.write_error is not None):
+                print ("[HistoryDB] the background write of the history database failed: " + str(self.write_error))
+        self.compact_logs()
+
+    def _task_key(self, task_parameter, names = None):
+
+        """ Canonical string of a dictionary of task parameters restricted to names (all of them if names is None), identical for equal values (e.g. 1 and 1.0) """
+        if (names is not None):
+            task_parameter = {name: task_parameter[name] for name in names}
+        return json.dumps({name: float(value) if isinstance(value, (int, float, np.integer, np.floating)) else str(value)
+            for (name, value) in task_parameter.items()}, sort_keys=True)
+
+    def _func_evals(self, json_data_path, problem : Problem, task_keys):
+
+        """ (task key, machine key, software key, record) of the function evaluations of the tasks task_keys, in insertion order """
+        if (self.storage == 'sqlite'):
+            conn = self._sqlite_connect(json_data_path)
+            try:
+                rows = []
+                task_keys = list(task_keys)
+                for k in range(0, len(task_keys), 500):   # bounded number of SQL parameters per query
+                    chunk = task_keys[k:k+500]
+                    rows += conn.execute("SELECT rowid, task_key, machine_key, software_key, record FROM func_eval WHERE problem = ? AND task_key IN (" + ",".join("?" * len(chunk)) + ")",
+                        [self.tuning_problem_name] + chunk).fetchall()
+            finally:
+                conn.close()
+            rows.sort()
+            for (rowid, task_key, machine_key, software_key, record) in rows:
+                yield (task_key, machine_key, software_key, json.loads(record))
+        else:
+            history_data = self._read_history_data(json_data_path)
+            for func_eval in history_data["func_eval"]:
+                task_key = self._task_key(func_eval["task_parameter"], self.task_parameter_names)
+                if (task_key in task_keys):
+                    yield (task_key, None, None, func_eval)
+
+    def check_load_deps(self, func_eval, machine_key = None, software_key = None):
+
+        """ Whether func_eval was obtained with a loadable machine and software configuration, memoized per configuration (machine_key and software_key are the canonical strings of the configurations if already known) """
+        if (machine_key is None):
+            machine_key = json.dumps(func_eval['machine_configuration'], sort_keys=True)
+        if (software_key is None):
+            software_key = json.dumps(func_eval['software_configuration'], sort_keys=True)
+        key = (machine_key, software_key)
+        if (key not in self.load_deps_cache):
+            self.load_deps_cache[key] = self._check_load_deps(func_eval)
+
+        return self.load_deps_cache[key]
+
+    def _check_load_deps(self, func_eval):
 
         ''' check machine configuration dependencies '''
         loadable_machine_configurations = self.loadable_machine_configurations
@@ -308,22 +773,11 @@ class HistoryDB(dict):
     def load_history_func_eval(self, data : Data, problem : Problem, Igiven : np.ndarray):
         """ Init history database JSON file """
         if (self.tuning_problem_name is not None):
+            self.flush(wait = True)   # include the records still queued by this instance
+            self.task_parameter_names = [problem.IS[j].name for j in range(len(problem.IS))]   # the task keys of both storage engines
             json_data_path = self.history_db_path+"/"+self.tuning_problem_name+".json"
-            if os.path.exists(json_data_path):
+            if self._history_exists(json_data_path):
                 print ("[HistoryDB] Found a history database file")
-                if self.file_synchronization_method == 'filelock':
-                    with FileLock(json_data_path+".lock"):
-                        with open(json_data_path, "r") as f_in:
-                            history_data = json.load(f_in)
-                elif self.file_synchronization_method == 'rsync':
-                    temp_path = json_data_path + "." + self.process_uid + ".temp"
-                    os.system("rsync -a " + json_data_path + " " + temp_path)
-                    with open(temp_path, "r") as f_in:
-                        history_data = json.load(f_in)
-                    os.system("rm " + temp_path)
-                else:
-                    with open(json_data_path, "r") as f_in:
-                        history_data = json.load(f_in)
 
                 num_tasks = len(Igiven)
 
@@ -332,35 +786,39 @@ class HistoryDB(dict):
                 PS_history = [[] for i in range(num_tasks)]
                 OS_history = [[] for i in range(num_tasks)]
 
-                for func_eval in history_data["func_eval"]:
-                    if (self.check_load_deps(func_eval)):
-                        task_id = self.search_func_eval_task_id(func_eval, problem, Igiven)
-                        if (task_id != -1):
-                            # # current policy: skip loading the func eval result
-                            # # if the same parameter data has been loaded once (duplicated)
-                            # # YL: only need to search in PS_history[task_id], not PS_history
-                            # if self.is_parameter_duplication(problem, PS_history[task_id], func_eval["tuning_parameter"]):
-                            
-                            # current policy: allow duplicated samples 
-                            # YL: This makes RCI-based multi-armed bandit much easier to implement, maybe we can add an option for changing this behavior 
-                            if False: # self.is_parameter_duplication(problem, PS_history[task_id], func_eval["tuning_parameter"]):
-                                continue
-                            else:
-                                parameter_arr = []
-                                for k in range(len(problem.PS)):
-                                    if type(problem.PS[k]).__name__ == "Categoricalnorm":
-                                        parameter_arr.append(str(func_eval["tuning_parameter"][problem.PS[k].name]))
-                                    elif type(problem.PS[k]).__name__ == "Integer":
-                                        parameter_arr.append(int(func_eval["tuning_parameter"][problem.PS[k].name]))
-                                    elif type(problem.PS[k]).__name__ == "Real":
-                                        parameter_arr.append(float(func_eval["tuning_parameter"][problem.PS[k].name]))
-                                    else:
-                                        parameter_arr.append(func_eval["tuning_parameter"][problem.PS[k].name])
-                                PS_history[task_id].append(parameter_arr)
-                                OS_history[task_id].append(\
-                                    [func_eval["evaluation_result"][problem.OS[k].name] \
-                                    for k in range(len(problem.OS))])
-                                num_loaded_data += 1
+                # the first task of Igiven with the same parameters, found by dictionary lookup (see search_func_eval_task_id)
+                task_ids = {}
+                for i in range(num_tasks):
+                    task_ids.setdefault(self._task_key({problem.IS[j].name: Igiven[i][j] for j in range(len(problem.IS))}), i)
+
+                for (task_key, machine_key, software_key, func_eval) in self._func_evals(json_data_path, problem, task_ids):
+                    if (self.check_load_deps(func_eval, machine_key, software_key)):
+                        task_id = task_ids[task_key]
+                        # # current policy: skip loading the func eval result
+                        # # if the same parameter data has been loaded once (duplicated)
+                        # # YL: only need to search in PS_history[task_id], not PS_history
+                        # if self.is_parameter_duplication(problem, PS_history[task_id], func_eval["tuning_parameter"]):
+                        
+                        # current policy: allow duplicated samples 
+                        # YL: This makes RCI-based multi-armed bandit much easier to implement, maybe we can add an option for changing this behavior 
+                        if False: # self.is_parameter_duplication(problem, PS_history[task_id], func_eval["tuning_parameter"]):
+                            continue
+                        else:
+                            parameter_arr = []
+                            for k in range(len(problem.PS)):
+                                if type(problem.PS[k]).__name__ == "Categoricalnorm":
+                                    parameter_arr.append(str(func_eval["tuning_parameter"][problem.PS[k].name]))
+                                elif type(problem.PS[k]).__name__ == "Integer":
+                                    parameter_arr.append(int(func_eval["tuning_parameter"][problem.PS[k].name]))
+                                elif type(problem.PS[k]).__name__ == "Real":
+                                    parameter_arr.append(float(func_eval["tuning_parameter"][problem.PS[k].name]))
+                                else:
+                                    parameter_arr.append(func_eval["tuning_parameter"][problem.PS[k].name])
+                            PS_history[task_id].append(parameter_arr)
+                            OS_history[task_id].append(\
+                                [func_eval["evaluation_result"][problem.OS[k].name] \
+                                for k in range(len(problem.OS))])
+                            num_loaded_data += 1
 
                 if (num_loaded_data > 0):
                     data.I = Igiven #IS_history
@@ -379,37 +837,24 @@ class HistoryDB(dict):
                     # print ("data.O: " + str(OS_history))
                 else:
                     print ("no history data has been loaded")
+            elif self.storage == 'sqlite':
+                print ("[HistoryDB] Create an SQLite database next to " + json_data_path)
+                self._sqlite_connect(json_data_path).close()
             else:
                 print ("[HistoryDB] Create a JSON file at " + json_data_path)
 
-                if self.file_synchronization_method == 'filelock':
-                    with FileLock(json_data_path+".lock"):
-                        with open(json_data_path, "w") as f_out:
-                            json_data = {"tuning_problem_name":self.tuning_problem_name,
-                                "model_data":[],
-                                "func_eval":[]}
-                            json.dump(json_data, f_out, indent=2)
-                elif self.file_synchronization_method == 'rsync':
-                    temp_path = json_data_path + "." + self.process_uid + ".temp"
-                    with open(temp_path, "w") as f_out:
-                        json_data = {"tuning_problem_name":self.tuning_problem_name,
+                with self._lock(json_data_path):
+                    if not os.path.exists(json_data_path):
+                        self._write_snapshot(json_data_path, {"tuning_problem_name":self.tuning_problem_name,
                             "model_data":[],
-                            "func_eval":[]}
-                        json.dump(json_data, f_out, indent=2)
-                    os.system("rsync -u " + temp_path + " " + json_data_path)
-                    os.system("rm " + temp_path)
-                else:
-                    with open(json_data_path, "w") as f_out:
-                        json_data = {"tuning_problem_name":self.tuning_problem_name,
-                            "model_data":[],
-                            "func_eval":[]}
-                        json.dump(json_data, f_out, indent=2)
+                            "func_eval":[]})
 
     def update_func_eval(self, problem : Problem,\
             task_parameter : np.ndarray,\
             tuning_parameter : np.ndarray,\
             evaluation_result : np.ndarray):
         if (self.tuning_problem_name is not None):
+            self.task_parameter_names = [problem.IS[j].name for j in range(len(problem.IS))]
             json_data_path = self.history_db_path+"/"+self.tuning_problem_name+".json"
 
             new_function_evaluation_results = []
@@ -475,41 +920,7 @@ class HistoryDB(dict):
                         "uid":str(uid)
                     })
 
-            if self.file_synchronization_method == 'filelock':
-                with FileLock(json_data_path+".lock"):
-                    with open(json_data_path, "r") as f_in:
-                        json_data = json.load(f_in)
-                        json_data["func_eval"] += new_function_evaluation_results
-                    with open(json_data_path, "w") as f_out:
-                        json.dump(json_data, f_out, indent=2)
-            elif self.file_synchronization_method == 'rsync':
-                while True:
-                    temp_path = json_data_path + "." + self.process_uid + ".temp"
-                    os.system("rsync -a " + json_data_path + " " + temp_path)
-                    with open(temp_path, "r") as f_in:
-                        json_data = json.load(f_in)
-                        json_data["func_eval"] += new_function_evaluation_results
-                    with open(temp_path, "w") as f_out:
-                        json.dump(json_data, f_out, indent=2)
-                    os.system("rsync -u " + temp_path + " " + json_data_path)
-                    os.system("rm " + temp_path)
-                    with open(json_data_path, "r") as f_in:
-                        json_data = json.load(f_in)
-                        existing_uids = [item["uid"] for item in json_data["func_eval"]]
-                        new_uids = [item["uid"] for item in new_function_evaluation_results]
-                        retry = False
-                        for uid in new_uids:
-                            if uid not in existing_uids:
-                                retry = True
-                                break
-                        if retry == False:
-                            break
-            else:
-                with open(json_data_path, "r") as f_in:
-                    json_data = json.load(f_in)
-                    json_data["func_eval"] += new_function_evaluation_results
-                with open(json_data_path, "w") as f_out:
-                    json.dump(json_data, f_out, indent=2)
+            self._queue_records(json_data_path, "func_eval", new_function_evaluation_results)
 
         return
 
@@ -574,29 +985,12 @@ class HistoryDB(dict):
 
         if (self.tuning_problem_name is not None):
             json_data_path = self.history_db_path+"/"+self.tuning_problem_name+".json"
-            if os.path.exists(json_data_path):
-                if self.file_synchronization_method == 'filelock':
-                    with FileLock(json_data_path+".lock"):
-                        with open(json_data_path, "r") as f_in:
-                            history_data = json.load(f_in)
-                elif self.file_synchronization_method == 'rsync':
-                    temp_path = json_data_path + "." + self.process_uid + ".temp"
-                    os.system("rsync -a " + json_data_path + " " + temp_path)
-                    with open(temp_path, "r") as f_in:
-                        history_data = json.load(f_in)
-                    os.system("rm " + temp_path)
-                else:
-                    with open(json_data_path, "r") as f_in:
-                        history_data = json.load(f_in)
+            if self._history_exists(json_data_path):
+                snapshot = self._history_snapshot(json_data_path)
 
-                num_models = len(history_data["model_data"])
-
-                max_evals = 0
-                max_evals_index = -1 # TODO: if no model is found?
-                for i in range(num_models):
-                    model_data = history_data["model_data"][i]
-                    if (self.is_model_problem_match(model_data, tuningproblem, Igiven) and
-                        model_data["modeler"] == modeler):
+                for i in snapshot["modeler"].get(modeler, []):
+                    model_data = snapshot["model_data"][i]
+                    if (self.is_model_problem_match(model_data, tuningproblem, Igiven)):
                         ret.append(model_data)
 
         return ret
@@ -605,35 +999,21 @@ class HistoryDB(dict):
             input_given : np.ndarray, objective : int, modeler : str):
         if (self.tuning_problem_name is not None):
             json_data_path = self.history_db_path+"/"+self.tuning_problem_name+".json"
-            if os.path.exists(json_data_path):
-                if self.file_synchronization_method == 'filelock':
-                    with FileLock(json_data_path+".lock"):
-                        with open(json_data_path, "r") as f_in:
-                            history_data = json.load(f_in)
-                elif self.file_synchronization_method == 'rsync':
-                    temp_path = json_data_path + "." + self.process_uid + ".temp"
-                    os.system("rsync -a " + json_data_path + " " + temp_path)
-                    with open(temp_path, "r") as f_in:
-                        history_data = json.load(f_in)
-                    os.system("rm " + temp_path)
-                else:
-                    with open(json_data_path, "r") as f_in:
-                        history_data = json.load(f_in)
+            if self._history_exists(json_data_path):
+                snapshot = self._history_snapshot(json_data_path)
 
                 max_mle = -9999
                 max_mle_index = -1
-                for i in range(len(history_data["model_data"])):
-                    model_data = history_data["model_data"][i]
-                    if (self.is_model_problem_match(model_data, tuningproblem, input_given) and
-                            model_data["modeler"] == modeler and
-                            model_data["objective_id"] == objective):
+                for i in snapshot["model"].get((modeler, objective), []):
+                    model_data = snapshot["model_data"][i]
+                    if (self.is_model_problem_match(model_data, tuningproblem, input_given)):
                         log_likelihood = model_data["log_likelihood"]
                         if log_likelihood > max_mle:
                             max_mle = log_likelihood
                             max_mle_index = i
 
                 hyperparameters =\
-                        history_data["model_data"][max_mle_index]["hyperparameters"]
+                        snapshot["model_data"][max_mle_index]["hyperparameters"]
 
         return hyperparameters
 
@@ -641,28 +1021,14 @@ class HistoryDB(dict):
             input_given : np.ndarray, objective : int, modeler : str):
         if (self.tuning_problem_name is not None):
             json_data_path = self.history_db_path+"/"+self.tuning_problem_name+".json"
-            if os.path.exists(json_data_path):
-                if self.file_synchronization_method == 'filelock':
-                    with FileLock(json_data_path+".lock"):
-                        with open(json_data_path, "r") as f_in:
-                            history_data = json.load(f_in)
-                elif self.file_synchronization_method == 'rsync':
-                    temp_path = json_data_path + "." + self.process_uid + ".temp"
-                    os.system("rsync -a " + json_data_path + " " + temp_path)
-                    with open(temp_path, "r") as f_in:
-                        history_data = json.load(f_in)
-                    os.system("rm " + temp_path)
-                else:
-                    with open(json_data_path, "r") as f_in:
-                        history_data = json.load(f_in)
+            if self._history_exists(json_data_path):
+                snapshot = self._history_snapshot(json_data_path)
 
                 min_aic = 99999
                 min_aic_index = -1
-                for i in range(len(history_data["model_data"])):
-                    model_data = history_data["model_data"][i]
-                    if (self.is_model_problem_match(model_data, tuningproblem, input_given) and
-                            model_data["modeler"] == modeler and
-                            model_data["objective_id"] == objective):
+                for i in snapshot["model"].get((modeler, objective), []):
+                    model_data = snapshot["model_data"][i]
+                    if (self.is_model_problem_match(model_data, tuningproblem, input_given)):
                         log_likelihood = model_data["log_likelihood"]
                         num_parameters = len(model_data["hyperparameters"])
                         AIC = -1.0 * 2.0 * log_likelihood + 2.0 * num_parameters
@@ -671,7 +1037,7 @@ class HistoryDB(dict):
                             min_aic_index = i
 
                 hyperparameters =\
-                        history_data["model_data"][min_aic_index]["hyperparameters"]
+                        snapshot["model_data"][min_aic_index]["hyperparameters"]
 
         return hyperparameters
 
@@ -681,28 +1047,14 @@ class HistoryDB(dict):
 
         if (self.tuning_problem_name is not None):
             json_data_path = self.history_db_path+"/"+self.tuning_problem_name+".json"
-            if os.path.exists(json_data_path):
-                if self.file_synchronization_method == 'filelock':
-                    with FileLock(json_data_path+".lock"):
-                        with open(json_data_path, "r") as f_in:
-                            history_data = json.load(f_in)
-                elif self.file_synchronization_method == 'rsync':
-                    temp_path = json_data_path + "." + self.process_uid + ".temp"
-                    os.system("rsync -a " + json_data_path + " " + temp_path)
-                    with open(temp_path, "r") as f_in:
-                        history_data = json.load(f_in)
-                    os.system("rm " + temp_path)
-                else:
-                    with open(json_data_path, "r") as f_in:
-                        history_data = json.load(f_in)
+            if self._history_exists(json_data_path):
+                snapshot = self._history_snapshot(json_data_path)
 
                 min_bic = 99999
                 min_bic_index = -1
-                for i in range(len(history_data["model_data"])):
-                    model_data = history_data["model_data"][i]
-                    if (self.is_model_problem_match(model_data, tuningproblem, input_given) and
-                            model_data["modeler"] == modeler and
-                            model_data["objective_id"] == objective):
+                for i in snapshot["model"].get((modeler, objective), []):
+                    model_data = snapshot["model_data"][i]
+                    if (self.is_model_problem_match(model_data, tuningproblem, input_given)):
                         log_likelihood = model_data["log_likelihood"]
                         num_parameters = len(model_data["hyperparameters"])
                         num_samples = len(model_data["func_eval"])
@@ -712,7 +1064,7 @@ class HistoryDB(dict):
                             min_bic_index = i
 
                 hyperparameters =\
-                        history_data["model_data"][min_bic_index]["hyperparameters"]
+                        snapshot["model_data"][min_bic_index]["hyperparameters"]
 
         return hyperparameters
 
@@ -720,35 +1072,21 @@ class HistoryDB(dict):
             input_given : np.ndarray, objective : int, modeler : str):
         if (self.tuning_problem_name is not None):
             json_data_path = self.history_db_path+"/"+self.tuning_problem_name+".json"
-            if os.path.exists(json_data_path):
-                if self.file_synchronization_method == 'filelock':
-                    with FileLock(json_data_path+".lock"):
-                        with open(json_data_path, "r") as f_in:
-                            history_data = json.load(f_in)
-                elif self.file_synchronization_method == 'rsync':
-                    temp_path = json_data_path + "." + self.process_uid + ".temp"
-                    os.system("rsync -a " + json_data_path + " " + temp_path)
-                    with open(temp_path, "r") as f_in:
-                        history_data = json.load(f_in)
-                    os.system("rm " + temp_path)
-                else:
-                    with open(json_data_path, "r") as f_in:
-                        history_data = json.load(f_in)
+            if self._history_exists(json_data_path):
+                snapshot = self._history_snapshot(json_data_path)
 
                 max_evals = 0
                 max_evals_index = -1 # TODO: if no model is found?
-                for i in range(len(history_data["model_data"])):
-                    model_data = history_data["model_data"][i]
-                    if (self.is_model_problem_match(model_data, tuningproblem, input_given) and
-                            model_data["modeler"] == modeler and
-                            model_data["objective_id"] == objective):
-                        num_evals = len(history_data["model_data"][i]["func_eval"])
+                for i in snapshot["model"].get((modeler, objective), []):
+                    model_data = snapshot["model_data"][i]
+                    if (self.is_model_problem_match(model_data, tuningproblem, input_given)):
+                        num_evals = len(snapshot["model_data"][i]["func_eval"])
                         if num_evals > max_evals:
                             max_evals = num_evals
                             max_evals_index = i
 
                 hyperparameters =\
-                        history_data["model_data"][max_evals_index]["hyperparameters"]
+                        snapshot["model_data"][max_evals_index]["hyperparameters"]
                 print ("loaded hyperparameters: ", hyperparameters)
 
         return hyperparameters
@@ -756,26 +1094,11 @@ class HistoryDB(dict):
     def load_model_hyperparameters_by_uid(self, model_uid):
         if (self.tuning_problem_name is not None):
             json_data_path = self.history_db_path+"/"+self.tuning_problem_name+".json"
-            if os.path.exists(json_data_path):
-                if self.file_synchronization_method == 'filelock':
-                    with FileLock(json_data_path+".lock"):
-                        with open(json_data_path, "r") as f_in:
-                            history_data = json.load(f_in)
-                elif self.file_synchronization_method == 'rsync':
-                    temp_path = json_data_path + "." + self.process_uid + ".temp"
-                    os.system("rsync -a " + json_data_path + " " + temp_path)
-                    with open(temp_path, "r") as f_in:
-                        history_data = json.load(f_in)
-                    os.system("rm " + temp_path)
-                else:
-                    with open(json_data_path, "r") as f_in:
-                        history_data = json.load(f_in)
+            if self._history_exists(json_data_path):
+                snapshot = self._history_snapshot(json_data_path)
 
-                model_data = history_data["model_data"]
-                num_models = len(model_data)
-                for i in range(num_models):
-                    if model_data[i]["uid"] == model_uid:
-                        return model_data[i]["hyperparameters"]
+                if model_uid in snapshot["uid"]:
+                    return snapshot["model_data"][snapshot["uid"][model_uid]]["hyperparameters"]
 
         return []
 
@@ -855,7 +1178,7 @@ class HistoryDB(dict):
             new_surrogate_models.append({
                     "hyperparameters":bestxopt.tolist(),
                     "model_stats":model_stats,
-                    "func_eval":self.uids,
+                    "func_eval":list(self.uids),   # copied: the record is serialized at the next flush, after this iteration's evaluations are added to self.uids
                     "task_parameters":task_parameter_orig_list,
                     "problem_space":problem_space,
                     "modeler":"Model_LCM",
@@ -876,40 +1199,6 @@ class HistoryDB(dict):
                     # we might need a nicer way to manage different models
                 })
 
-            if self.file_synchronization_method == 'filelock':
-                with FileLock(json_data_path+".lock"):
-                    with open(json_data_path, "r") as f_in:
-                        json_data = json.load(f_in)
-                        json_data["model_data"] += new_surrogate_models
-                    with open(json_data_path, "w") as f_out:
-                        json.dump(json_data, f_out, indent=2)
-            elif self.file_synchronization_method == 'rsync':
-                while True:
-                    temp_path = json_data_path + "." + self.process_uid + ".temp"
-                    os.system("rsync -a " + json_data_path + " " + temp_path)
-                    with open(temp_path, "r") as f_in:
-                        json_data = json.load(f_in)
-                        json_data["model_data"] += new_surrogate_models
-                    with open(temp_path, "w") as f_out:
-                        json.dump(json_data, f_out, indent=2)
-                    os.system("rsync -u " + temp_path + " " + json_data_path)
-                    os.system("rm " + temp_path)
-                    with open(json_data_path, "r") as f_in:
-                        json_data = json.load(f_in)
-                        existing_uids = [item["uid"] for item in json_data["model_data"]]
-                        new_uids = [item["uid"] for item in new_surrogate_models]
-                        retry = False
-                        for uid in new_uids:
-                            if uid not in existing_uids:
-                                retry = True
-                                break
-                        if retry == False:
-                            break
-            else:
-                with open(json_data_path, "r") as f_in:
-                    json_data = json.load(f_in)
-                    json_data["model_data"] += new_surrogate_models
-                with open(json_data_path, "w") as f_out:
-                    json.dump(json_data, f_out, indent=2)
+            self._queue_records(json_data_path, "model_data", new_surrogate_models)
 
         return
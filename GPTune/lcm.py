@@ -24,9 +24,12 @@ import mpi4py
 from mpi4py import MPI
 import itertools
 import scipy
+import scipy.linalg
 import sys
 from sys import platform
 import time
+import threading
+import atexit
 
 ROOTDIR = os.path.abspath(__file__ + "/../../build")
 
@@ -169,9 +172,12 @@ class LCM(GPy.kern.Kern):
         # print("cadfdfo",X1)
         return K
 
-    def Kdiag(self, X):   # Required for GPy
+    def Kdiag(self, X):   # Required for GPy, k(x,x) = sum_q B_q[t,t]*var_q only depends on the task index t of x, no need to form K(X,X)
 
-        return np.diag(self.K(X, X2=X))
+        tasks = np.asarray(X)[:,-1].astype(int)
+        BS = self.BS.reshape((self.Q, self.num_outputs, self.num_outputs))
+
+        return np.dot(BS[:, tasks, tasks].T, self.var)
 
     def update_gradients_full(self, dL_dK, X1, X2=None):
 
@@ -189,7 +195,7 @@ class LCM(GPy.kern.Kern):
 
         raise("Not implemented")
 
-    def train_kernel(self, X, Y, computer, kwargs):
+    def train_kernel(self, X, Y, computer, kwargs, pool = None, warm_start = False):
         npernode = int(computer.cores/kwargs['model_threads'])
         maxtries = kwargs['model_max_jitter_try']
         mpi_size=kwargs['model_processes']  # this makes sure every rank belongs to the blacs grid
@@ -198,11 +204,16 @@ class LCM(GPy.kern.Kern):
         mpi_size = nprow * npcol
 
         t1 = time.time_ns()
-        mpi_comm = computer.spawn(__file__, nproc=mpi_size, nthreads=kwargs['model_threads'], npernode=npernode, kwargs = kwargs)
+        if (pool is None):
+            mpi_comm = computer.spawn(__file__, nproc=mpi_size, nthreads=kwargs['model_threads'], npernode=npernode, kwargs = kwargs)
+        else:
+            config = (mpi_size, kwargs['model_threads'], npernode)
+            mpi_comm = pool.acquire(config, kwargs)
         t2 = time.time_ns()
         if (kwargs['verbose']):
             print('LCM spawn time: ',(t2-t1)/1e9)
 
+        # the tasks can have different numbers of samples: every row carries its task index, which is all cliblcm uses to pick the entries of B_q
         X = np.concatenate([np.concatenate([X[i], np.ones((len(X[i]), 1)) * i], axis=1) for i in range(len(X))])
         Y = np.array(list(itertools.chain.from_iterable(Y)))
 
@@ -292,7 +303,8 @@ class LCM(GPy.kern.Kern):
         x0_log = inverse_transform_x(x0)
 
         # x0_log[0]=0
-        x0_log[list(range(len(self.theta),len(self.theta)+len(self.var)))]=0
+        if (not warm_start):   # a warm start keeps the variances of the previous optimum
+            x0_log[list(range(len(self.theta),len(self.theta)+len(self.var)))]=0
         # x0_log[2]=0
         # x0_log[3]=-10
         # x0_log[4]=-10
@@ -305,7 +317,13 @@ class LCM(GPy.kern.Kern):
         # print(bounds)
 
         # sol = scipy.optimize.minimize(fun, x0_log, args=(), method='L-BFGS-B', jac=grad)
-        sol = scipy.optimize.minimize(fun, x0_log, args=(), method='L-BFGS-B', jac=grad, bounds=bounds, tol=None, callback=None, options={'disp': None, 'maxcor': 10, 'ftol': 1e-32, 'gtol': 1e-05, 'eps': 1e-08, 'maxfun': 1000, 'maxiter': 1000, 'iprint': -1, 'maxls': 100})
+        if (warm_start):   # started close to the previous optimum: stop earlier
+            maxiter = kwargs['model_warm_start_max_iters']
+            ftol = kwargs['model_warm_start_ftol']
+        else:
+            maxiter = 1000
+            ftol = 1e-32
+        sol = scipy.optimize.minimize(fun, x0_log, args=(), method='L-BFGS-B', jac=grad, bounds=bounds, tol=None, callback=None, options={'disp': None, 'maxcor': 10, 'ftol': ftol, 'gtol': 1e-05, 'eps': 1e-08, 'maxfun': maxiter, 'maxiter': maxiter, 'iprint': -1, 'maxls': 100})
 
         # print(sol.x,'after')
         # print(transform_x(sol.x),'after exp')  # sol.x is not yet transformed
@@ -352,12 +370,298 @@ class LCM(GPy.kern.Kern):
     #        xopt = transform_x(xopt)
 
         self.set_param_array(xopt)
-        _ = mpi_comm.bcast(("end", None), root=mpi4py.MPI.ROOT)
-
-        mpi_comm.Disconnect()
+        if (pool is None):
+            _ = mpi_comm.bcast(("end", None), root=mpi4py.MPI.ROOT)
+            mpi_comm.Disconnect()
+        else:
+            _ = mpi_comm.bcast(("release", None), root=mpi4py.MPI.ROOT)
+            pool.release(config, mpi_comm, compute_time = (t4-t3)/1e9)
 
         return (xopt, fopt, gradients, iteration[0])
 
+
+class LCM_Posterior(object):
+
+    """
+    Cholesky factor L of K(X,X) + diag(sigma) (+1e-8, as in GPy's exact inference) and alpha = (K + diag(sigma))^{-1} Y for the training samples X of an LCM kernel.
+    The rows of X are [x, task index] and are kept in the order in which they were added, so that the factor can be extended with k new samples in O(N^2 k) as long as the hyperparameters are unchanged.
+    """
+
+    def __init__(self, kern, X, Y, L = None, alpha = None):
+
+        self.kern = kern
+        self.X = X
+        self.Y = Y
+        if (L is None):
+            self.factorize()
+        else:
+            self.L = L
+            self.alpha = alpha
+            self.predictor = LCM_Predictor(self.kern, self.X, self.L, self.alpha)
+
+    def noise(self, X):
+
+        return self.kern.sigma[X[:,-1].astype(int)] + 1e-8
+
+    def factorize(self):
+
+        K = self.kern.K(np.asfortranarray(self.X))   # LCM.K reads its inputs in column major
+        K[np.diag_indices_from(K)] += self.noise(self.X)
+        self.L = GPy.util.linalg.jitchol(K)
+        self.alpha = scipy.linalg.cho_solve((self.L, True), self.Y)
+        self.predictor = LCM_Predictor(self.kern, self.X, self.L, self.alpha)
+
+    def extend(self, Xnew, Ynew):
+
+        N = self.X.shape[0]
+        k = Xnew.shape[0]
+        if (k == 0):
+            return
+        K12 = self.kern.K(np.asfortranarray(self.X), np.asfortranarray(Xnew))
+        K22 = self.kern.K(np.asfortranarray(Xnew))
+        K22[np.diag_indices_from(K22)] += self.noise(Xnew)
+
+        L21T = scipy.linalg.solve_triangular(self.L, K12, lower=True)
+        L22 = GPy.util.linalg.jitchol(K22 - np.dot(L21T.T, L21T))
+
+        L = np.zeros((N + k, N + k))
+        L[:N,:N] = self.L
+        L[N:,:N] = L21T.T
+        L[N:,N:] = L22
+        self.L = L
+        self.X = np.vstack((self.X, Xnew))
+        self.Y = np.vstack((self.Y, Ynew))
+        self.alpha = scipy.linalg.cho_solve((self.L, True), self.Y)
+        self.predictor = LCM_Predictor(self.kern, self.X, self.L, self.alpha)
+
+    def neg_log_marginal_likelihood(self):
+
+        """ Negative log marginal likelihood of the samples for the hyperparameters of the kernel, as computed by fun_jac of cliblcm """
+        return 0.5 * (self.X.shape[0] * np.log(2 * np.pi) + 2 * np.sum(np.log(np.diag(self.L))) + np.sum(self.Y * self.alpha))
+
+    def predict(self, Xs):   # noiseless mean and variance, same as GPy's predict_noiseless
+
+        return self.predictor.predict(Xs)
+
+    def predict_gradient(self, Xs):
+
+        return self.predictor.predict_gradient(Xs)
+
+
+class LCM_SparsePosterior(object):
+
+    """
+    Inducing-point (DTC) approximation of the LCM posterior, used by Model_LCM when options['model_sparse'] is set.
+    The inducing inputs Z are a per-task subset of the training samples X (rows [x, task index]). With Kuu = K(Z,Z), Kuf = K(Z,X) and Lambda = diag(sigma) (+1e-8):
+        Sigma = Kuu + Kuf Lambda^{-1} Kfu
+        mu(x) = k(x,Z) Sigma^{-1} Kuf Lambda^{-1} Y
+        var(x) = k(x,x) - k(x,Z) Kuu^{-1} k(Z,x) + k(x,Z) Sigma^{-1} k(Z,x)
+    which costs O(N M^2) for N samples and M inducing inputs instead of the O(N^3) of LCM_Posterior.
+    """
+
+    def __init__(self, kern, X, Y, Z):
+
+        self.kern = kern
+        self.X = X
+        self.Y = Y
+        self.Z = Z
+        self.factorize()
+
+    def noise(self, X):
+
+        return self.kern.sigma[X[:,-1].astype(int)] + 1e-8
+
+    def factorize(self):
+
+        Kuu = self.kern.K(np.asfortranarray(self.Z))   # LCM.K reads its inputs in column major
+        Kuf = self.kern.K(np.asfortranarray(self.Z), np.asfortranarray(self.X))
+        Lu = GPy.util.linalg.jitchol(Kuu)
+        s = 1. / np.sqrt(self.noise(self.X))
+        A = scipy.linalg.solve_triangular(Lu, Kuf * s, lower=True)   # Lu^{-1} Kuf Lambda^{-1/2}
+        LB = GPy.util.linalg.jitchol(np.eye(self.Z.shape[0]) + np.dot(A, A.T))
+        LS = np.dot(Lu, LB)   # Cholesky factor of Sigma = Lu (I + A A^T) Lu^T, formed this way to stay well conditioned
+        c = scipy.linalg.solve_triangular(LB, np.dot(A, s.reshape((-1, 1)) * self.Y), lower=True)
+        w = scipy.linalg.solve_triangular(LS, c, lower=True, trans='T')   # Sigma^{-1} Kuf Lambda^{-1} Y
+        self.predictor = LCM_Predictor(self.kern, self.Z, Lu, w, L2 = LS)
+
+    def extend(self, Xnew, Ynew):   # the inducing inputs are kept, the O(N M^2) factorization is redone
+
+        if (Xnew.shape[0] == 0):
+            return
+        self.X = np.vstack((self.X, Xnew))
+        self.Y = np.vstack((self.Y, Ynew))
+        self.factorize()
+
+    def predict(self, Xs):
+
+        return self.predictor.predict(Xs)
+
+    def predict_gradient(self, Xs):
+
+        return self.predictor.predict_gradient(Xs)
+
+
+class LCM_Predictor(object):
+
+    """
+    Noiseless LCM predictions computed by cliblcm (K_cross and K_diag, OpenMP) from contiguous copies of the training samples X, the Cholesky factor L, alpha and the hyperparameters theta, var and BS.
+    This is what the search calls for every candidate, so it bypasses GPy and the column-major conventions of LCM.K, and the prior variance costs O(Q) per point instead of forming K(Xs,Xs).
+    For the inducing-point posterior, X holds the inducing inputs and the optional second factor L2 adds back k(x,X) (L2 L2^T)^{-1} k(X,x) to the variance.
+    """
+
+    def __init__(self, kern, X, L, alpha, L2 = None):
+
+        self.DI = kern.input_dim - 1
+        self.NT = kern.num_outputs
+        self.Q = kern.Q
+        self.theta = np.array(kern.theta, dtype=np.double)
+        self.var = np.array(kern.var, dtype=np.double)
+        self.BS = np.array(kern.BS, dtype=np.double)
+        self.X = np.array(X, dtype=np.double, order='C')
+        self.L = np.asfortranarray(L, dtype=np.double)   # what LAPACK's triangular solve expects, avoids a copy per call
+        self.alpha = np.ascontiguousarray(alpha, dtype=np.double)
+        self.L2 = None if L2 is None else np.asfortranarray(L2, dtype=np.double)
+
+    def K_cross(self, Xs):   # Xs is row major, one [x, task index] per row
+
+        K = np.empty((Xs.shape[0], self.X.shape[0]))
+        cliblcm.K_cross(ctypes.c_int(self.DI),\
+                ctypes.c_int(self.NT),\
+                ctypes.c_int(self.Q),\
+                ctypes.c_int(Xs.shape[0]),\
+                ctypes.c_int(self.X.shape[0]),\
+                self.theta.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),\
+                self.var.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),\
+                self.BS.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),\
+                Xs.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),\
+                self.X.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),\
+                K.ctypes.data_as(ctypes.POINTER(ctypes.c_double)))
+
+        return K
+
+    def K_diag(self, Xs):
+
+        D = np.empty(Xs.shape[0])
+        cliblcm.K_diag(ctypes.c_int(self.DI),\
+                ctypes.c_int(self.NT),\
+                ctypes.c_int(self.Q),\
+                ctypes.c_int(Xs.shape[0]),\
+                self.var.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),\
+                self.BS.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),\
+                Xs.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),\
+                D.ctypes.data_as(ctypes.POINTER(ctypes.c_double)))
+
+        return D
+
+    def predict_gradient(self, Xs):
+
+        """ Mean and variance as predict, together with their gradients with respect to the tuning parameters of the points of Xs (arrays of size m x DI) """
+        Xs = np.ascontiguousarray(Xs, dtype=np.double)
+        ts = Xs[:,-1].astype(int)
+        tX = self.X[:,-1].astype(int)
+        BS = self.BS.reshape((self.Q, self.NT, self.NT))
+        diff = Xs[:, None, :self.DI] - self.X[None, :, :self.DI]
+        Kx = np.zeros((Xs.shape[0], self.X.shape[0]))
+        dK = np.zeros((self.DI, Xs.shape[0], self.X.shape[0]))   # dK[d] = dk(Xs, X)/dXs_d
+        for q in range(self.Q):
+            theta2 = np.square(self.theta[q * self.DI : (q + 1) * self.DI])
+            Kq = BS[q][np.ix_(ts, tX)] * self.var[q] * np.exp(-0.5 * np.sum(np.square(diff) / theta2, axis=2))
+            Kx += Kq
+            dK -= np.moveaxis(diff / theta2, 2, 0) * Kq
+
+        mu = np.dot(Kx, self.alpha)
+        dmu = np.einsum('dij,j->id', dK, self.alpha[:,0])
+        W = scipy.linalg.cho_solve((self.L, True), Kx.T, check_finite=False)
+        var = self.K_diag(Xs) - np.einsum('ij,ji->i', Kx, W)
+        dvar = -2 * np.einsum('dij,ji->id', dK, W)
+        if (self.L2 is not None):
+            W = scipy.linalg.cho_solve((self.L2, True), Kx.T, check_finite=False)
+            var += np.einsum('ij,ji->i', Kx, W)
+            dvar += 2 * np.einsum('dij,ji->id', dK, W)
+
+        return (mu, var.reshape((-1, 1)), dmu, dvar)
+
+    def predict(self, Xs):
+
+        Xs = np.ascontiguousarray(Xs, dtype=np.double)
+        Kx = self.K_cross(Xs)
+        mu = np.dot(Kx, self.alpha)
+        tmp = scipy.linalg.solve_triangular(self.L, Kx.T, lower=True, check_finite=False)
+        var = self.K_diag(Xs) - np.square(tmp).sum(0)
+        if (self.L2 is not None):
+            tmp = scipy.linalg.solve_triangular(self.L2, Kx.T, lower=True, check_finite=False)
+            var += np.square(tmp).sum(0)
+
+        return (mu, var.reshape((-1, 1)))
+
+
+class LCM_WorkerPool(object):
+
+    """
+    Long-lived groups of LCM worker processes (the __main__ block of this file).
+    A group is spawned the first time a given (nproc, nthreads, npernode) configuration is requested and is then reused by every later train_kernel call, so that the interpreter startup and the imports of GPy, numpy and cliblcm are paid only once per GPTune instance.
+    Several groups can be alive at the same time when model restarts are trained concurrently by threads.
+    """
+
+    def __init__(self, computer):
+
+        self.computer = computer
+        self.idle = []   # list of (config, mpi_comm) of the groups not currently used by a train_kernel call
+        self.busy = 0
+        self.lock = threading.Lock()
+        self.stats = {
+            "spawn_time": 0,
+            "spawn_count": 0,
+            "reuse_count": 0,
+            "compute_time": 0
+        }
+        atexit.register(self.shutdown)
+
+    def acquire(self, config, kwargs):
+
+        mpi_comm = None
+        with self.lock:
+            for k in range(len(self.idle)):
+                if (self.idle[k][0] == config):
+                    mpi_comm = self.idle.pop(k)[1]
+                    break
+            self.busy += 1
+
+        if (mpi_comm is not None):
+            mpi_comm.Ibarrier().Wait()   # wake up the idle workers waiting in Ibarrier (a blocking Barrier does not match a nonblocking one)
+            with self.lock:
+                self.stats["reuse_count"] += 1
+        else:
+            (nproc, nthreads, npernode) = config
+            t1 = time.time_ns()
+            mpi_comm = self.computer.spawn(__file__, nproc=nproc, nthreads=nthreads, npernode=npernode, kwargs=kwargs)
+            t2 = time.time_ns()
+            with self.lock:
+                self.stats["spawn_time"] += (t2-t1)/1e9
+                self.stats["spawn_count"] += 1
+
+        return mpi_comm
+
+    def release(self, config, mpi_comm, compute_time = 0):
+
+        with self.lock:
+            self.idle.append((config, mpi_comm))
+            self.busy -= 1
+            self.stats["compute_time"] += compute_time
+
+    def shutdown(self):
+
+        atexit.unregister(self.shutdown)   # the pool is not kept referenced until exit once shut down
+        if (MPI.Is_finalized()):
+            return
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for (config, mpi_comm) in idle:
+            mpi_comm.Ibarrier().Wait()
+            _ = mpi_comm.bcast(("end", None), root=mpi4py.MPI.ROOT)
+            mpi_comm.Disconnect()
+
 if __name__ == "__main__":
 
     from ctypes import Structure, c_int, c_double, c_void_p, POINTER
@@ -407,7 +711,8 @@ if __name__ == "__main__":
     nprow = int(np.sqrt(mpi_size))
     npcol = mpi_size // nprow
     #    assert(nprow * npcol == mpi_size)
-    mb = 32
+    mb0 = 32
+    z = None
 
     cond = True
     while (cond):
@@ -418,8 +723,10 @@ if __name__ == "__main__":
 
         if (res[0] == "init"):
 
+            if (z is not None):   # a pooled worker is re-initialized with new data
+                cliblcm.finalize(z)
             (ker_lcm, X, Y, maxtries) = res[1]
-            mb = min(mb, max(1,min(X.shape[0]//nprow, X.shape[0]//npcol)))   # YL: mb <=32 doesn't seem reasonable, comment this line out ?
+            mb = min(mb0, max(1,min(X.shape[0]//nprow, X.shape[0]//npcol)))   # YL: mb <=32 doesn't seem reasonable, comment this line out ?
             # # print('mb',mb,'nprow',nprow,'npcol',npcol)
             cliblcm.initialize.restype = POINTER(fun_jac_struct)
             z = cliblcm.initialize (\
@@ -447,9 +754,19 @@ if __name__ == "__main__":
             if (mpi_rank == 0):
                 mpi_comm.send((neg_log_marginal_likelihood, gradients), dest=0)
 
+        elif (res[0] == "release"):
+
+            cliblcm.finalize(z)
+            z = None
+            # the group stays alive in LCM_WorkerPool; wait for the next training without busy-polling the cores used by the other phases
+            req = mpi_comm.Ibarrier()
+            while (not req.Test()):
+                time.sleep(0.01)
+
         elif (res[0] == "end"):
 
             cond = False
-            cliblcm.finalize(z)
+            if (z is not None):
+                cliblcm.finalize(z)
             mpi_comm.Disconnect()
 
@@ -18,9 +18,12 @@
 import abc
 from typing import Collection, Tuple
 import numpy as np
+import time
+import threading
+import atexit
 
 from problem import Problem
-from computer import Computer
+from computer import Computer, schedule_dynamic, work_dynamic
 from data import Data
 
 import mpi4py
@@ -53,6 +56,15 @@ class Model(abc.ABC):
 
         raise Exception("Abstract method")
 
+    # make predictions on a 2D array of sample points (one per row) of a specific task tid, returns the means and variances as two column vectors
+    def predict_batch(self, points : np.ndarray, tid : int, **kwargs) -> Tuple[np.ndarray, np.ndarray]:
+
+        res = [self.predict(x, tid=tid, **kwargs) for x in points]
+        mu = np.array([r[0] for r in res]).reshape((-1, 1))
+        var = np.array([r[1] for r in res]).reshape((-1, 1))
+
+        return (mu, var)
+
 
 import GPy
 
@@ -160,6 +172,15 @@ class Model_GPy_LCM(Model):
 
         return (mu, var)
 
+    def predict_batch(self, points : np.ndarray, tid : int, **kwargs) -> Tuple[np.ndarray, np.ndarray]:
+
+        x = np.empty((points.shape[0], points.shape[1] + 1))
+        x[:,:-1] = points
+        x[:,-1] = tid
+        (mu, var) = self.M.predict_noiseless(x)
+
+        return (mu, var)
+
     def get_correlation_metric(self, delta):
         print("In model.py, delta = ", delta)
         Q = delta # number of latent processes 
@@ -181,6 +202,22 @@ class Model_GPy_LCM(Model):
 
 class Model_LCM(Model):
 
+    def __init__(self, problem : Problem, computer : Computer, **kwargs):
+
+        super(Model_LCM, self).__init__(problem, computer, **kwargs)
+        self.lcm_pool = None   # LCM_WorkerPool reused by all the train_kernel calls, set by GPTune
+        self.model_pool = None   # ModelWorkerPool reused by all the distributed trainings, set by GPTune
+        self.posterior = None  # LCM_Posterior used for prediction, it can be extended with new samples without refactorization
+        self.P_train = None    # per-task samples factorized in self.posterior
+        self.O_train = None
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['lcm_pool'] = None   # the pools hold MPI communicators, which are not picklable
+        state['model_pool'] = None
+        return state
+
     def train(self, data : Data, **kwargs):
 
         return self.train_mpi(data, i_am_manager = True, restart_iters=list(range(kwargs['model_restarts'])), **kwargs)
@@ -195,18 +232,39 @@ class Model_LCM(Model):
         else:
             Q = kwargs['model_latent']
 
+        xwarm = self.warm_start_hyperparameters(data, Q, **kwargs)
+        (P, O) = self.training_samples(data, **kwargs)
+
+        def init_kernel(restart_iter):
+            kern = LCM(input_dim = len(data.P[0][0]), num_outputs = data.NI, Q = Q)
+            if (xwarm is not None):   # restart 0 starts from the previous optimum, the others from perturbations of it
+                if (restart_iter == 0):
+                    kern.set_param_array(xwarm)
+                else:
+                    x = np.log10(xwarm) + kwargs['model_warm_start_perturbation'] * np.random.randn(len(xwarm))
+                    kern.set_param_array(np.power(10, x))
+            return kern
+
         if (kwargs['distributed_memory_parallelism'] and i_am_manager):
-            mpi_comm = self.computer.spawn(__file__, nproc=kwargs['model_restart_processes'], nthreads=kwargs['model_restart_threads'], kwargs=kwargs) # XXX add args and kwargs
-            kwargs_tmp = kwargs
-            # print("kwargs_tmp",kwargs_tmp)
-
-            if "mpi_comm" in kwargs_tmp:
-                del kwargs_tmp["mpi_comm"]   # mpi_comm is not picklable
-            _ = mpi_comm.bcast((self, data, restart_iters, kwargs_tmp), root=mpi4py.MPI.ROOT)
-            tmpdata = mpi_comm.gather(None, root=mpi4py.MPI.ROOT)
-            mpi_comm.Disconnect()
+            if (self.model_pool is not None):
+                kwargs_tmp = kwargs
+                if "mpi_comm" in kwargs_tmp:
+                    del kwargs_tmp["mpi_comm"]   # mpi_comm is not picklable
+                tmpdata = self.model_pool.run(self, data, restart_iters, (kwargs['model_restart_processes'], kwargs['model_restart_threads']), kwargs_tmp)
+            else:
+                mpi_comm = self.computer.spawn(__file__, nproc=kwargs['model_restart_processes'], nthreads=kwargs['model_restart_threads'], kwargs=kwargs) # XXX add args and kwargs
+                kwargs_tmp = kwargs
+                # print("kwargs_tmp",kwargs_tmp)
+
+                if "mpi_comm" in kwargs_tmp:
+                    del kwargs_tmp["mpi_comm"]   # mpi_comm is not picklable
+                _ = mpi_comm.bcast(("once", (self, data, kwargs_tmp)), root=mpi4py.MPI.ROOT)
+                tmpdata = schedule_dynamic(mpi_comm, restart_iters, "model")   # the restarts are handed out one at a time, as their L-BFGS iteration counts differ
+                for p in range(mpi_comm.Get_remote_size()):
+                    _ = mpi_comm.recv(source=p, tag=1)   # LCM timings of the worker ranks, only kept by ModelWorkerPool
+                mpi_comm.Disconnect()
             res=[]
-            for p in range(int(kwargs['model_restart_processes'])):
+            for p in range(len(tmpdata)):
                 res = res + tmpdata[p]
 
         elif (kwargs['shared_memory_parallelism']): #YL: not tested
@@ -220,19 +278,24 @@ class Model_LCM(Model):
                     #     seed = restart_iter
                     # np.random.seed(seed)
                     ## np.random.seed()
-                    kern = LCM(input_dim = len(data.P[0][0]), num_outputs = data.NI, Q = Q)
-                    # if (restart_iter == 0 and self.M is not None):
-                    #     kern.set_param_array(self.M.kern.get_param_array())
-                    return kern.train_kernel(X = data.P, Y = data.O, computer = self.computer, kwargs = kwargs)
+                    kern = init_kernel(restart_iter)
+                    return kern.train_kernel(X = P, Y = O, computer = self.computer, kwargs = kwargs, pool = self.lcm_pool, warm_start = xwarm is not None)
                 res = list(executor.map(fun, restart_iters, timeout=None, chunksize=1))
 
         else:
+            if (self.lcm_pool is None and kwargs['distributed_memory_parallelism']):   # spawned restart worker: share one LCM group among its restarts
+                from lcm import LCM_WorkerPool
+                pool = LCM_WorkerPool(self.computer)
+            else:
+                pool = self.lcm_pool
             def fun(restart_iter):
                 # np.random.seed(restart_iter)
                 np.random.seed()
-                kern = LCM(input_dim = len(data.P[0][0]), num_outputs = data.NI, Q = Q)
-                return kern.train_kernel(X = data.P, Y = data.O, computer = self.computer, kwargs = kwargs)
+                kern = init_kernel(restart_iter)
+                return kern.train_kernel(X = P, Y = O, computer = self.computer, kwargs = kwargs, pool = pool, warm_start = xwarm is not None)
             res = list(map(fun, restart_iters))
+            if (pool is not self.lcm_pool):
+                pool.shutdown()
 
         if (kwargs['distributed_memory_parallelism'] and i_am_manager == False):
             return res
@@ -243,6 +306,14 @@ class Model_LCM(Model):
         neg_log_marginal_likelihood = best_result[1]
         gradients = best_result[2]
         iteration = best_result[3]
+        if (kwargs['model_incremental'] and not kwargs['model_sparse'] and self.posterior is not None):
+            xprev = self.M.kern.get_param_array()
+            if (len(xprev) == len(bestxopt) and np.max(np.abs(np.log10(bestxopt) - np.log10(xprev))) <= kwargs['model_incremental_tol'] and self.extend(data)):
+                # the hyperparameters barely moved: keep the previous ones and extend their Cholesky factor instead of refactorizing
+                if(kwargs['verbose']==True):
+                    print('hyperparameters within model_incremental_tol, extending the previous Cholesky factor')
+                return (xprev, self.posterior.neg_log_marginal_likelihood(), gradients, iteration)   # the likelihood of xprev on all the samples, from the extended factor
+
         kern.set_param_array(bestxopt)
         if(kwargs['verbose']==True):
             # print('hyperparameters:', kern.get_param_array())
@@ -257,7 +328,8 @@ class Model_LCM(Model):
 
         # YL: likelihoods needs to be provided, since K operator doesn't take into account sigma/jittering, but Kinv does. The GPCoregionalizedRegression intialization will call inference in GPy/interence/latent_function_inference/exact_gaussian_inference.py, and add to diagonals of the K operator with sigma+1e-8
         likelihoods_list = [GPy.likelihoods.Gaussian(variance = kern.sigma[i], name = "Gaussian_noise_%s" %i) for i in range(data.NI)]
-        self.M = GPy.models.GPCoregionalizedRegression(data.P, data.O, kern, likelihoods_list = likelihoods_list)
+        self.M = GPy.models.GPCoregionalizedRegression(P, O, kern, likelihoods_list = likelihoods_list)
+        self.build_posterior(data, **kwargs)
 
         #print ("kernel: " + str(kern))
         #print ("bestxopt:" + str(bestxopt))
@@ -273,10 +345,83 @@ class Model_LCM(Model):
 
         return (bestxopt, neg_log_marginal_likelihood, gradients, iteration)
 
+    def warm_start_hyperparameters(self, data : Data, Q : int, **kwargs):
+
+        """ Hyperparameters of the current model if they can seed the restarts of the next training (options['model_warm_start']), None otherwise """
+
+        if (not kwargs['model_warm_start'] or self.M is None or not hasattr(self.M.kern, 'get_param_array')):
+            return None
+        x = self.M.kern.get_param_array()
+        DI = len(data.P[0][0])
+        if (len(x) != Q * DI + Q + 2 * Q * data.NI + data.NI):   # the number of tasks, latent functions or features changed
+            return None
+
+        return x
+
+    def training_samples(self, data : Data, **kwargs):
+
+        """ Per-task samples on which the hyperparameters are fitted: all of them, or in the sparse mode (options['model_sparse']) the inducing inputs, a subset evenly spread over the history of each task """
+
+        if (not kwargs['model_sparse']):
+            return (data.P, data.O)
+
+        lenx = sum([len(P) for P in data.P])
+        if (kwargs['model_inducing'] is None):
+            model_inducing = int(min(lenx, 3 * np.sqrt(lenx)))
+        else:
+            model_inducing = kwargs['model_inducing']
+        P = []
+        O = []
+        for i in range(len(data.P)):
+            n = len(data.P[i])
+            m = min(n, max(1, int(round(model_inducing * n / lenx))))
+            idx = np.unique(np.round(np.linspace(0, n - 1, m)).astype(int))   # deterministic, so that the spawned restart workers fit the same subset
+            P.append(data.P[i][idx])
+            O.append(data.O[i][idx])
+
+        return (P, O)
+
+    def build_posterior(self, data : Data, **kwargs):
+
+        if (kwargs['RCI_mode'] is False):
+            from lcm import LCM_Posterior, LCM_SparsePosterior
+
+        if (kwargs['model_sparse']):
+            X = np.concatenate([np.concatenate([data.P[i], np.ones((len(data.P[i]), 1)) * i], axis=1) for i in range(len(data.P))])
+            Y = np.concatenate(data.O)
+            self.posterior = LCM_SparsePosterior(self.M.kern, X, Y, np.array(self.M.X))   # self.M holds the inducing inputs
+        else:
+            # GPCoregionalizedRegression stacks the samples task by task with the task index as last column, as train_kernel does, so its factorization can be reused as is
+            self.posterior = LCM_Posterior(self.M.kern, np.array(self.M.X), np.array(self.M.Y), L = self.M.posterior.woodbury_chol, alpha = self.M.posterior.woodbury_vector)
+        self.P_train = list(data.P)
+        self.O_train = list(data.O)
+
+    def extend(self, data : Data) -> bool:
+
+        """ Add to the factorization the samples of data that are not in the model yet, keeping the hyperparameters. Returns False if data does not extend the samples of the model. """
+
+        if (self.posterior is None or len(data.P) != len(self.P_train)):
+            return False
+        Xnew = []
+        Ynew = []
+        for i in range(len(data.P)):
+            ns = len(self.P_train[i])
+            if (len(data.P[i]) < ns or not np.array_equal(data.P[i][0:ns], self.P_train[i]) or not np.array_equal(data.O[i][0:ns], self.O_train[i])):
+                return False
+            Xnew.append(np.hstack((data.P[i][ns:], np.ones((len(data.P[i]) - ns, 1)) * i)))
+            Ynew.append(data.O[i][ns:])
+        self.posterior.extend(np.vstack(Xnew), np.vstack(Ynew))   # O(N^2 k) instead of O((N+k)^3); note that self.M keeps the previous samples
+        self.P_train = list(data.P)
+        self.O_train = list(data.O)
+
+        return True
+
     def update(self, newdata : Data, do_train: bool = False, **kwargs):
 
-        #XXX TODO
-        self.train(newdata, **kwargs)
+        if (do_train):
+            self.train(newdata, **kwargs)
+        elif (not self.extend(newdata)):
+            self.gen_model_from_hyperparameters(newdata, self.M.kern.get_param_array(), **kwargs)
 
     # make prediction on a single sample point of a specific task tid
     def predict(self, points : Collection[np.ndarray], tid : int, **kwargs) -> Collection[Tuple[float, float]]:
@@ -284,10 +429,30 @@ class Model_LCM(Model):
         x = np.empty((1, points.shape[0] + 1))
         x[0,:-1] = points
         x[0,-1] = tid
-        (mu, var) = self.M.predict_noiseless(x)   # predict_noiseless ueses precomputed Kinv and Kinv*y (generated at GPCoregionalizedRegression init, which calls inference in GPy/inference/latent_function_inference/exact_gaussian_inference.py) to compute mu and var, with O(N^2) complexity, see "class PosteriorExact(Posterior): _raw_predict" of GPy/inference/latent_function_inference/posterior.py.
+        (mu, var) = self.posterior.predict(x)   # same as self.M.predict_noiseless: uses the Cholesky factor and Kinv*y of the training samples, with O(N^2) complexity, see "class PosteriorExact(Posterior): _raw_predict" of GPy/inference/latent_function_inference/posterior.py.
+
+        return (mu, var)
+
+    # make predictions on a 2D array of sample points of a specific task tid with one kernel matrix product and one triangular solve for the whole batch
+    def predict_batch(self, points : np.ndarray, tid : int, **kwargs) -> Tuple[np.ndarray, np.ndarray]:
+
+        x = np.empty((points.shape[0], points.shape[1] + 1))
+        x[:,:-1] = points
+        x[:,-1] = tid
+        (mu, var) = self.posterior.predict(x)
 
         return (mu, var)
 
+    # make predictions on a 2D array of sample points of a specific task tid, together with the gradients of the means and variances with respect to the points (one row per point)
+    def predict_batch_gradient(self, points : np.ndarray, tid : int, **kwargs) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+
+        x = np.empty((points.shape[0], points.shape[1] + 1))
+        x[:,:-1] = points
+        x[:,-1] = tid
+        (mu, var, dmu, dvar) = self.posterior.predict_gradient(x)
+
+        return (mu, var, dmu, dvar)
+
     def gen_model_from_hyperparameters(self, data : Data, hyperparameters : list, **kwargs):
         if (kwargs['RCI_mode'] is False):
             from lcm import LCM
@@ -302,10 +467,81 @@ class Model_LCM(Model):
         kern.set_param_array(hyperparameters)
 
         likelihoods_list = [GPy.likelihoods.Gaussian(variance = kern.sigma[i], name = "Gaussian_noise_%s" %i) for i in range(data.NI)]
-        self.M = GPy.models.GPCoregionalizedRegression(data.P, data.O, kern, likelihoods_list = likelihoods_list)
+        (P, O) = self.training_samples(data, **kwargs)
+        self.M = GPy.models.GPCoregionalizedRegression(P, O, kern, likelihoods_list = likelihoods_list)   # built on the inducing inputs only in the sparse mode
+        self.build_posterior(data, **kwargs)
 
         return
 
+class ModelWorkerPool(object):
+
+    """
+    Long-lived groups of model restart worker processes (the __main__ block of this file), reused by every distributed Model_LCM training of a GPTune instance.
+    Each worker rank keeps its own LCM_WorkerPool, so that the LCM groups of its restarts are spawned once and reused across the MLA iterations as well.
+    As these LCM groups live in the worker processes, their spawn and compute times are sent back after every training (lcm_spawn_time and lcm_compute_time).
+    Several groups can be alive at the same time when the objectives are trained concurrently by threads.
+    """
+
+    def __init__(self, computer):
+
+        self.computer = computer
+        self.idle = []   # list of (config, mpi_comm) of the groups not currently used by a training
+        self.lock = threading.Lock()
+        self.stats = {
+            "spawn_time": 0,
+            "spawn_count": 0,
+            "reuse_count": 0,
+            "lcm_spawn_time": 0,
+            "lcm_compute_time": 0
+        }
+        atexit.register(self.shutdown)
+
+    def run(self, model, data, restart_iters, config, kwargs):
+
+        mpi_comm = None
+        with self.lock:
+            for k in range(len(self.idle)):
+                if (self.idle[k][0] == config):
+                    mpi_comm = self.idle.pop(k)[1]
+                    break
+
+        if (mpi_comm is not None):
+            mpi_comm.Ibarrier().Wait()   # wake up the idle workers waiting in Ibarrier
+            with self.lock:
+                self.stats["reuse_count"] += 1
+        else:
+            (nproc, nthreads) = config
+            t1 = time.time_ns()
+            mpi_comm = self.computer.spawn(__file__, nproc=nproc, nthreads=nthreads, kwargs=kwargs)
+            t2 = time.time_ns()
+            with self.lock:
+                self.stats["spawn_time"] += (t2-t1)/1e9
+                self.stats["spawn_count"] += 1
+
+        _ = mpi_comm.bcast(("train", (model, data, kwargs)), root=mpi4py.MPI.ROOT)
+        res = schedule_dynamic(mpi_comm, restart_iters, "model")   # the restarts are handed out one at a time, as their L-BFGS iteration counts differ
+        lcm_stats = [mpi_comm.recv(source=p, tag=1) for p in range(mpi_comm.Get_remote_size())]
+
+        with self.lock:
+            self.stats["lcm_spawn_time"] += sum(x[0] for x in lcm_stats)
+            self.stats["lcm_compute_time"] += sum(x[1] for x in lcm_stats)
+            self.idle.append((config, mpi_comm))
+
+        return res
+
+    def shutdown(self):
+
+        atexit.unregister(self.shutdown)   # the pool is not kept referenced until exit once shut down
+        if (MPI.Is_finalized()):
+            return
+        with self.lock:
+            idle = self.idle
+            self.idle = []
+        for (config, mpi_comm) in idle:
+            mpi_comm.Ibarrier().Wait()
+            _ = mpi_comm.bcast(("end", None), root=mpi4py.MPI.ROOT)
+            mpi_comm.Disconnect()
+
 class Model_DGP(Model):
 
     def train(self, data : Data, **kwargs):
@@ -398,9 +634,38 @@ if __name__ == '__main__':
     mpi_comm = MPI.Comm.Get_parent()
     mpi_rank = mpi_comm.Get_rank()
     mpi_size = mpi_comm.Get_size()
-    (modeler, data, restart_iters, kwargs) = mpi_comm.bcast(None, root=0)
-    restart_iters_loc = restart_iters[mpi_rank:len(restart_iters):mpi_size]
-    tmpdata = modeler.train_mpi(data, i_am_manager = False, restart_iters = restart_iters_loc, **kwargs)
-    res = mpi_comm.gather(tmpdata, root=0)
+    lcm_pool = None   # LCM groups of this rank, shared by all the restarts handed out to it and kept across the trainings of ModelWorkerPool
+
+    cond = True
+    while (cond):
+
+        (cmd, payload) = mpi_comm.bcast(None, root=0)
+        if (cmd == "end"):
+            break
+
+        (modeler, data, kwargs) = payload
+        lcm_stats0 = (0, 0)
+        if (isinstance(modeler, Model_LCM)):
+            if (lcm_pool is None):
+                from lcm import LCM_WorkerPool
+                lcm_pool = LCM_WorkerPool(modeler.computer)
+            modeler.lcm_pool = lcm_pool
+            lcm_stats0 = (lcm_pool.stats["spawn_time"], lcm_pool.stats["compute_time"])
+        work_dynamic(mpi_comm, lambda restart_iter: modeler.train_mpi(data, i_am_manager = False, restart_iters = [restart_iter], **kwargs))
+        if (lcm_pool is not None):   # the manager cannot time the LCM groups of this rank
+            mpi_comm.send((lcm_pool.stats["spawn_time"] - lcm_stats0[0], lcm_pool.stats["compute_time"] - lcm_stats0[1]), dest=0, tag=1)
+        else:
+            mpi_comm.send((0, 0), dest=0, tag=1)
+
+        if (cmd == "once"):
+            cond = False
+        else:
+            # the group stays alive in ModelWorkerPool; wait for the next training without busy-polling the cores used by the other phases
+            req = mpi_comm.Ibarrier()
+            while (not req.Test()):
+                time.sleep(0.01)
+
+    if (lcm_pool is not None):
+        lcm_pool.shutdown()
     mpi_comm.Disconnect()
 
@@ -52,16 +52,24 @@ class Options(dict):
         model_restarts = 1 # Number of random starts each building one initial GP model
         model_restart_processes = None  # Number of MPIs each handling one random start
         model_restart_threads = None   # Number of threads each handling one random start
+        model_objective_threads = None   # Number of objectives whose models are trained concurrently by a multi-objective MLA, each on its own group of processes/threads, defaults to 1
         model_max_iters = 15000   # Number of maximum iterations for the optimizers
         model_latent = None # Number of latent functions for building one LCM model, defaults to number of tasks
-        model_sparse = False # Whether to use SparseGPRegression or SparseGPCoregionalizedRegression from Model_GPy_LCM
-        model_inducing = None # Number of inducing points for SparseGPRegression or SparseGPCoregionalizedRegression
+        model_sparse = False # Whether to use SparseGPRegression or SparseGPCoregionalizedRegression from Model_GPy_LCM, or the inducing-point mode of Model_LCM
+        model_inducing = None # Number of inducing points for SparseGPRegression, SparseGPCoregionalizedRegression or the sparse Model_LCM
         model_layers = 2 # Number of layers for Model_DGP
         model_max_jitter_try = 10 # Max number of jittering 
+        model_features_vectorized = False # Whether the performance models (problem.models) take all the samples of a task at once: tuning parameters as 1D arrays, other parameters as scalars, returning one row per sample
+        model_incremental = False # Whether Model_LCM extends the Cholesky factor of the previous MLA iteration with the new samples (O(N^2)) instead of refactorizing the covariance matrix (O(N^3)) when the hyperparameters are unchanged
+        model_incremental_tol = 1e-3 # Largest change of the log10 hyperparameters of Model_LCM for which the previous Cholesky factor is extended
+        model_warm_start = False # Whether Model_LCM starts the first restart from the hyperparameters of the previous MLA iteration and the other restarts from perturbations of them
+        model_warm_start_perturbation = 0.5 # Standard deviation (in log10 scale) of the perturbations of the warm-started restarts
+        model_warm_start_max_iters = 200 # Max number of L-BFGS iterations/function evaluations for warm-started restarts (1000 otherwise)
+        model_warm_start_ftol = 1e-9 # Relative reduction of the likelihood at which L-BFGS stops for warm-started restarts (1e-32 otherwise)
 
 
         """ Options for the search phase """
-        search_class = 'SearchPyGMO' # Supported searcher classes: 'SearchPyGMO'
+        search_class = 'SearchPyGMO' # Supported searcher classes: 'SearchPyGMO', 'SearchLBFGS' -- multi-start L-BFGS-B on the EI, single-objective only
         search_threads = None  # Number of threads in each thread group handling one task
         search_processes = 1  # Reserved option
         search_multitask_threads = None # Number of threads groups each handling one task
@@ -73,6 +81,16 @@ class Options(dict):
         search_evolve = 10  # Number of times migration in pgymo
         search_max_iters = 10  # Max number of searches to get results respecting the constraints
         search_more_samples = 1  # Maximum number of points selected using a multi-objective search algorithm
+        search_mo_selection = 'crowding'  # How the search_more_samples points are picked from the final population of a multi-objective search: 'crowding' -- non-dominated fronts, the last one truncated by crowding distance, 'hypervolume' -- non-dominated fronts, the last one truncated by removing the least hypervolume contributors, 'first' -- the first rows of the population
+        search_warm_start = False  # True: seed the populations (islands) of every task with its final populations of the previous search_multitask call
+        search_warm_start_gen = None  # Number of evolution generations of a warm-started search, None: search_gen
+        search_batch_size = 1  # Number of points selected per task and per MLA iteration by a single-objective search, chosen from the final populations by local penalization of the EI, so that they can be evaluated in parallel
+        search_batch_radius = 0.1  # Radius, in the normalized parameter space, of the local penalization around each point of a batch
+        search_duplicate_tol = 0  # Candidates closer than this distance (in the normalized parameter space) to an evaluated sample of the same task are rejected as duplicates, 0: only exact duplicates are rejected
+        search_lbfgs_candidates = 1000  # Number of random points among which the starting points of SearchLBFGS are selected
+        search_lbfgs_starts = 10  # Number of starting points optimized by SearchLBFGS
+        search_lbfgs_max_iters = 100  # Max number of L-BFGS-B iterations of SearchLBFGS
+        search_batch_fitness = False  # True: let pygmo evaluate whole populations at once through SurrogateProblem.batch_fitness (batched model predictions), False: one fitness call per individual
 
 
         """ Options for the multi-arm bandit algorithm """
@@ -121,12 +139,24 @@ class Options(dict):
             self['model_restart_processes'] = 1
             self['model_restart_threads'] = 1
 
+        if(self['model_objective_threads'] is None):
+            self['model_objective_threads'] = 1
+        if (self['model_objective_threads'] > 1 and (self['distributed_memory_parallelism'] or self['model_class']=='Model_LCM')):   # the concurrent objectives spawn and drive MPI worker groups from several threads
+            from mpi4py import MPI
+            if (MPI.Query_thread() != MPI.THREAD_MULTIPLE):
+                print('model_objective_threads > 1 requires MPI_THREAD_MULTIPLE, the objectives are trained one after another')
+                self['model_objective_threads'] = 1
+        if (self['distributed_memory_parallelism']):   # the objectives trained concurrently share the cores available for modeling
+            self['model_restart_processes'] = max(1,min(self['model_restart_processes'],math.floor((computer.cores*computer.nodes-2)/self['model_objective_threads'])))
+        elif(self['shared_memory_parallelism']):
+            self['model_restart_threads'] = max(1,min(self['model_restart_threads'],math.floor(computer.cores/self['model_objective_threads'])))
+
         if (self['model_class']=='Model_LCM'):
             if(self['model_processes'] is None):
                 if (self['distributed_memory_parallelism']):
-                    self['model_processes'] = max(1,math.floor(((computer.cores*computer.nodes-1)/(self['model_restart_processes'])-1)/self['model_restart_threads']))
+                    self['model_processes'] = max(1,math.floor(((computer.cores*computer.nodes-1)/(self['model_restart_processes']*self['model_objective_threads'])-1)/self['model_restart_threads']))
                 else:
-                    self['model_processes'] = max(1,math.floor((computer.cores*computer.nodes-1)/self['model_restart_processes']/self['model_restart_threads']))
+                    self['model_processes'] = max(1,math.floor((computer.cores*computer.nodes-1)/self['model_restart_processes']/self['model_restart_threads']/self['model_objective_threads']))
             self['model_threads'] =1
         else:
             self['model_processes'] = 1
@@ -171,9 +201,9 @@ class Options(dict):
 
 
         if(self['distributed_memory_parallelism']):
-            ncore_model = (self['model_processes']+1)*self['model_threads']*self['model_restart_processes']+1
+            ncore_model = (self['model_processes']+1)*self['model_threads']*self['model_restart_processes']*self['model_objective_threads']+1
         else:
-            ncore_model = (self['model_processes']+1)*self['model_threads']*self['model_restart_threads']
+            ncore_model = (self['model_processes']+1)*self['model_threads']*self['model_restart_threads']*self['model_objective_threads']
 
         if(self['verbose']==True):    
             print("  ")
@@ -182,6 +212,7 @@ class Options(dict):
             print("   ---> model_threads:", self['model_threads'])
             print("   ---> model_restart_processes:", self['model_restart_processes'])
             print("   ---> model_restart_threads:", self['model_restart_threads'])
+            print("   ---> model_objective_threads:", self['model_objective_threads'])
 
 
         if(self['distributed_memory_parallelism']):
@@ -216,7 +247,7 @@ class Options(dict):
                 raise Exception("the computer should has at least 2 total cores")
 
             if ((computer.cores*computer.nodes)<ncore_model):
-                raise Exception("Reduce one of the options: model_restart_processes,model_restart_threads,model_processes,model_threads")
+                raise Exception("Reduce one of the options: model_restart_processes,model_restart_threads,model_processes,model_threads,model_objective_threads")
             if ((computer.cores*computer.nodes)<ncore_search):
                 raise Exception("Reduce one of the options: search_multitask_processes,search_multitask_threads,search_processes,search_threads")
             if ((computer.cores*computer.nodes)<ncore_obj):
@@ -20,9 +20,15 @@ import concurrent
 from concurrent import futures
 import sys
 import abc
+import copy
+import time
+import atexit
 from typing import Collection
 import numpy as np
 import scipy as sp
+import scipy.optimize
+import scipy.special
+import scipy.spatial
 import functools
 from joblib import *
 
@@ -32,9 +38,9 @@ from mpi4py import MPI
 from mpi4py import futures
 
 from problem import Problem
-from computer import Computer
+from computer import Computer, CompiledConstraints, import_driver, schedule_dynamic, work_dynamic
 from data import Data
-from model import Model
+from model import Model, Model_LCM
 
 from pathlib import Path
 import importlib
@@ -45,12 +51,47 @@ class Search(abc.ABC):
     def __init__(self, problem : Problem, computer : Computer):
         self.problem = problem
         self.computer = computer
+        self.pool = None   # SearchWorkerPool reused by all the search_multitask calls, set by GPTune
+        self.populations = {}   # final population (decision vectors in the normalized space) of every task, kept for options['search_warm_start']
+
+    def __getstate__(self):
+
+        state = self.__dict__.copy()
+        state['pool'] = None   # the pool holds an MPI communicator, which is not picklable
+        return state
 
     @abc.abstractmethod
     def search(self, data : Data, models : Collection[Model], tid : int, **kwargs) -> np.ndarray:
 
         raise Exception("Abstract method")
 
+    def select_batch(self, xs, fs, q, radius):   # xs are candidates in the normalized space and fs their fitness, i.e. -EI
+
+        """
+        Greedy batch selection by local penalization: the candidate with the largest EI is taken first, then the EI of every candidate is multiplied by 1 - exp(-|x - x_j|^2 / (2 radius^2)) for each selected x_j before taking the next one.
+        Candidates mapping to an already selected point of the original space are skipped, so that the q points of the batch are distinct evaluations.
+        """
+        feasible = fs < float('Inf')
+        xs = xs[feasible]
+        ei = -fs[feasible]
+        weight = np.ones(len(ei))
+        selected = []
+        keys = set()
+        while (len(selected) < q):
+            score = np.maximum(ei, 0) * weight
+            j = int(np.argmax(score))
+            if (weight[j] == 0 or (len(selected) > 0 and score[j] <= 0)):
+                break
+            weight[j] = 0
+            key = tuple(self.problem.PS.inverse_transform(np.array(xs[j], ndmin=2))[0])
+            if (key in keys):
+                continue
+            keys.add(key)
+            selected.append(xs[j])
+            weight *= 1 - np.exp(-np.sum((xs - xs[j])**2, axis=1) / (2 * radius**2))
+
+        return np.array(selected).reshape(len(selected), self.problem.DP)
+
     def search_multitask(self, data : Data, models : Collection[Model], tids : Collection[int] = None, i_am_manager : bool = True, **kwargs) -> Collection[np.ndarray]:
 
         if (tids is None):
@@ -59,15 +100,18 @@ class Search(abc.ABC):
         if ((kwargs['distributed_memory_parallelism'] or _platform == "darwin") and i_am_manager):   # the pgymo install on mac os seems buggy if search is not spawned 
             nproc = min(kwargs['search_multitask_processes'],data.NI)
             npernode = int(self.computer.cores/kwargs['search_multitask_threads'])
-            mpi_comm = self.computer.spawn(__file__, nproc=nproc, nthreads=kwargs['search_multitask_threads'], npernode=npernode, kwargs=kwargs) # XXX add args and kwargs
             kwargs_tmp = kwargs
             if "mpi_comm" in kwargs_tmp:
                 del kwargs_tmp["mpi_comm"]   # mpi_comm is not picklable
-            _ = mpi_comm.bcast((self, data, models, tids, kwargs_tmp), root=mpi4py.MPI.ROOT)
-            tmpdata = mpi_comm.gather(None, root=mpi4py.MPI.ROOT)
-            mpi_comm.Disconnect()
+            if (self.pool is not None):
+                tmpdata = self.pool.run(self, data, models, tids, (nproc, kwargs['search_multitask_threads'], npernode), kwargs_tmp)
+            else:
+                mpi_comm = self.computer.spawn(__file__, nproc=nproc, nthreads=kwargs['search_multitask_threads'], npernode=npernode, kwargs=kwargs) # XXX add args and kwargs
+                _ = mpi_comm.bcast(("once", (self, data, models, kwargs_tmp)), root=mpi4py.MPI.ROOT)
+                tmpdata = schedule_dynamic(mpi_comm, tids, "search")   # the tasks are handed out one at a time, as tightly constrained tasks need more search_max_iters retries
+                mpi_comm.Disconnect()
             res=[]
-            for p in range(int(nproc)):
+            for p in range(len(tmpdata)):
                 res = res + tmpdata[p]
 
 
@@ -85,16 +129,121 @@ class Search(abc.ABC):
             res = list(map(fun, tids))
         # print(res)
         res.sort(key = lambda x : x[0])
+        for x in res:
+            if (len(x) > 2):   # (tid, bestX, population)
+                self.populations[x[0]] = x[2]
         return res
 
+class SearchWorkerPool(object):
+
+    """
+    Long-lived group of search worker processes (the __main__ block of this file), reused by every distributed search_multitask call of a GPTune instance.
+    The first call (or a call after the tasks, the samples or the kind of models changed) sends the searcher, the data and the models in full.
+    Later calls send only the new samples of every task, the new samples of the training data of every Model_LCM model (its objective column of O, with the performance model features appended to P) and the hyperparameters:
+    the workers append the samples and rebuild their predictors locally, extending the Cholesky factor when the hyperparameters did not change.
+    Models without hyperparameters to rebuild from (e.g. Model_GPy_LCM) are always sent in full.
+    """
+
+    def __init__(self, computer):
+
+        self.computer = computer
+        self.config = None     # (nproc, nthreads, npernode) of the spawned group
+        self.mpi_comm = None
+        self.sent = None       # (I, D, P, O, [(P_train, O_train) of every model]) of the data and models held by the workers
+        self.stats = {
+            "spawn_time": 0,
+            "spawn_count": 0,
+            "reuse_count": 0,
+            "full_count": 0,
+            "delta_count": 0
+        }
+        atexit.register(self.shutdown)
+
+    def delta(self, data, models):
+
+        """ (Pnew, Onew, training, hyperparameters) bringing the workers up to date with data and models, where training holds the (Pnew, Onew) of the training data of every model, or None if they have to receive them in full """
+
+        if (self.sent is None or not all(isinstance(model, Model_LCM) and model.posterior is not None for model in models)):
+            return None
+        (I, D, P, O, trained) = self.sent
+        if (len(trained) != len(models) or not np.array_equal(I, data.I) or not np.array_equal(D, data.D)):
+            return None
+        new = self.new_samples(P, O, data.P, data.O)
+        if (new is None):
+            return None
+        training = []
+        for (model, (Ptrain, Otrain)) in zip(models, trained):   # the models are trained on data.view(objective = o), possibly with features: not a prefix of data
+            training.append(self.new_samples(Ptrain, Otrain, model.P_train, model.O_train))
+            if (training[-1] is None):
+                return None
+
+        return new + (training, [model.M.kern.get_param_array() for model in models])
+
+    def new_samples(self, P, O, Pcur, Ocur):
+
+        """ (Pnew, Onew) such that Pcur and Ocur are P and O followed by Pnew and Onew for every task, or None if they are not """
+
+        if (P is None or Pcur is None or len(P) != len(Pcur)):
+            return None
+        Pnew = []
+        Onew = []
+        for i in range(len(Pcur)):
+            ns = len(P[i])
+            if (len(Pcur[i]) < ns or not np.array_equal(Pcur[i][0:ns], P[i]) or not np.array_equal(Ocur[i][0:ns], O[i])):
+                return None
+            Pnew.append(Pcur[i][ns:])
+            Onew.append(Ocur[i][ns:])
+
+        return (Pnew, Onew)
+
+    def run(self, searcher, data, models, tids, config, kwargs):
+
+        if (self.mpi_comm is not None and self.config != config):
+            self.shutdown()
+        if (self.mpi_comm is None):
+            (nproc, nthreads, npernode) = config
+            t1 = time.time_ns()
+            self.mpi_comm = self.computer.spawn(__file__, nproc=nproc, nthreads=nthreads, npernode=npernode, kwargs=kwargs)
+            t2 = time.time_ns()
+            self.config = config
+            self.stats["spawn_time"] += (t2-t1)/1e9
+            self.stats["spawn_count"] += 1
+        else:
+            self.mpi_comm.Ibarrier().Wait()   # wake up the idle workers waiting in Ibarrier (a blocking Barrier does not match a nonblocking one)
+            self.stats["reuse_count"] += 1
+
+        delta = self.delta(data, models)
+        if (delta is None):
+            _ = self.mpi_comm.bcast(("full", (searcher, data, models, kwargs)), root=mpi4py.MPI.ROOT)
+            self.stats["full_count"] += 1
+        else:
+            _ = self.mpi_comm.bcast(("delta", delta + (searcher.populations, kwargs)), root=mpi4py.MPI.ROOT)
+            self.stats["delta_count"] += 1
+        self.sent = (copy.deepcopy(data.I), copy.deepcopy(data.D), list(data.P), list(data.O), [(getattr(model, "P_train", None), getattr(model, "O_train", None)) for model in models])   # I and D can be updated in place (models_update), the models replace their P_train and O_train lists, never modify them
+
+        return schedule_dynamic(self.mpi_comm, tids, "search")
+
+    def shutdown(self):
+
+        atexit.unregister(self.shutdown)   # the pool is not kept referenced until exit once shut down
+        if (self.mpi_comm is None or MPI.Is_finalized()):
+            return
+        self.mpi_comm.Ibarrier().Wait()
+        _ = self.mpi_comm.bcast(("end", None), root=mpi4py.MPI.ROOT)
+        self.mpi_comm.Disconnect()
+        self.mpi_comm = None
+        self.sent = None
+
 class SurrogateProblem(object):
 
-    def __init__(self, problem, computer, data, models, tid):   # data is in the normalized space, IOrig and POrig are then generated in the original space
+    def __init__(self, problem, computer, data, models, tid, options = None):   # data is in the normalized space, IOrig and POrig are then generated in the original space
 
         self.problem = problem
         self.computer = computer
         self.data = data
         self.models = models
+        self.options = options
+        self.models_func = None   # performance models of the driver module
 
         self.tid = tid
 
@@ -103,6 +252,10 @@ class SurrogateProblem(object):
 
         # self.POrig = self.data.P[tid]
         self.POrig = self.problem.PS.inverse_transform(np.array(self.data.P[tid], ndmin=2))
+        self.POrig_keys = set(tuple(xx) for xx in self.POrig)   # exact duplicate queries in O(1)
+        self.tol = 0 if options is None else options['search_duplicate_tol']
+        self.tree = None   # KD-tree over the normalized evaluated points for the duplicate queries with tolerance, built on first use
+        self.ymin = np.min(np.array(self.data.O[tid], ndmin=2), axis=0)   # incumbent value of every objective for this task
 
     def get_nobj(self):
         return self.problem.DO
@@ -114,48 +267,123 @@ class SurrogateProblem(object):
         return ([0. for i in range(DP)], [1. for  i in range(DP)])
 
     # Acquisition function
+    def expected_improvement(self, mu, var):   # mu and var are 2D arrays, one row per point and one column per objective
+
+        """ Negated Expected Improvement over the incumbents self.ymin, evaluated elementwise """
+        std = np.sqrt(np.maximum(1e-18, var))
+        d = self.ymin - mu
+        chi = d / std
+        return -(d * sp.special.ndtr(chi) + std * np.exp(-0.5 * chi**2) / np.sqrt(2 * np.pi))
+
     def ei(self, x):
 
         """ Expected Improvement """
-        EI=[]
+        mu = np.empty((1, self.problem.DO))
+        var = np.empty((1, self.problem.DO))
         for o in range(self.problem.DO):
-            ymin = self.data.O[self.tid][:,o].min()
-            (mu, var) = self.models[o].predict(x, tid=self.tid)
-            mu = mu[0][0]
-            var = max(1e-18, var[0][0])
-            std = np.sqrt(var)
-            chi = (ymin - mu) / std
-            Phi = 0.5 * (1.0 + sp.special.erf(chi / np.sqrt(2)))
-            phi = np.exp(-0.5 * chi**2) / np.sqrt(2 * np.pi * var)
-            EI.append(-((ymin - mu) * Phi + var * phi))
-        return EI
+            (mu_o, var_o) = self.models[o].predict(x, tid=self.tid)
+            mu[0,o] = mu_o[0][0]
+            var[0,o] = var_o[0][0]
+        return list(self.expected_improvement(mu, var)[0])
+
+    def ei_batch(self, X):   # X is a 2D array of points in the normalized space, one per row
+
+        """ Expected Improvement of a batch of points, one row per point and one column per objective """
+        mu = np.empty((X.shape[0], self.problem.DO))
+        var = np.empty((X.shape[0], self.problem.DO))
+        for o in range(self.problem.DO):
+            (mu_o, var_o) = self.models[o].predict_batch(X, tid=self.tid)
+            mu[:,o] = mu_o[:,0]
+            var[:,o] = var_o[:,0]
+        return self.expected_improvement(mu, var)
+
+    def ei_gradient(self, X):   # X is a 2D array of points in the normalized space, one per row
+
+        """ Expected Improvement of a batch of points as ei_batch, and its gradient with respect to the points (one row per point, one column per objective, one slice per parameter), for models providing predict_batch_gradient """
+        mu = np.empty((X.shape[0], self.problem.DO))
+        var = np.empty((X.shape[0], self.problem.DO))
+        dmu = np.empty((X.shape[0], self.problem.DO, X.shape[1]))
+        dvar = np.empty((X.shape[0], self.problem.DO, X.shape[1]))
+        for o in range(self.problem.DO):
+            (mu_o, var_o, dmu[:,o,:], dvar[:,o,:]) = self.models[o].predict_batch_gradient(X, tid=self.tid)
+            mu[:,o] = mu_o[:,0]
+            var[:,o] = var_o[:,0]
+        dvar[var < 1e-18] = 0
+        std = np.sqrt(np.maximum(1e-18, var))
+        chi = (self.ymin - mu) / std
+        Phi = sp.special.ndtr(chi)
+        phi = np.exp(-0.5 * chi**2) / np.sqrt(2 * np.pi)
+        EI = -((self.ymin - mu) * Phi + std * phi)
+        dEI = Phi[:,:,np.newaxis] * dmu - (phi / (2 * std))[:,:,np.newaxis] * dvar
+        return (EI, dEI)
+
+    def ei_relaxed(self, X):   # X is a 2D array of points in the normalized space, one per row
+
+        """ Expected Improvement of a batch of points as ei_batch, but without the constraints, the duplicate check and the rounding to the original space, so that it is continuous in X """
+        if(self.problem.models is not None):
+            xi0 = self.problem.PS.inverse_transform(X)
+            points = [self.point(xi) for xi in xi0]
+            if(self.problem.constants is not None):
+                for point in points:
+                    point.update(self.problem.constants)
+            X = np.hstack((X, self.model_features(points)))
+        return self.ei_batch(X)
+
+    def point(self, xi):   # xi is in the original space
+
+        point0 = self.D
+        point2 = {self.problem.IS[k].name: self.IOrig[k] for k in range(self.problem.DI)}
+        point  = {self.problem.PS[k].name: xi[k] for k in range(self.problem.DP)}
+        point.update(point0)
+        point.update(point2)
+        return point
+
+    def duplicates(self, xi0):   # xi0 is a list of points in the original space
+
+        """ Boolean array telling which points of xi0 were already evaluated for this task: exact matches, and with options['search_duplicate_tol'] > 0 also the points closer than this tolerance to an evaluated point in the normalized space """
+        dup = np.array([tuple(xi) in self.POrig_keys for xi in xi0], dtype=bool)
+        if (self.tol > 0 and len(self.POrig) > 0 and len(xi0) > 0):
+            if (self.tree is None):
+                self.tree = scipy.spatial.cKDTree(np.array(self.data.P[self.tid], ndmin=2))
+            (dist, _) = self.tree.query(np.array(self.problem.PS.transform(xi0), ndmin=2), k=1, distance_upper_bound=self.tol)
+            dup = np.logical_or(dup, dist < self.tol)
+        return dup
+
+    def check(self, xi):   # xi is in the original space
+
+        """ Returns (cond, point): cond is True if xi is a new sample respecting the constraints, point is the dictionary passed to the constraints and the performance models """
+        if (self.duplicates([xi])[0]):
+            return (False, None)
+        point = self.point(xi)
+        # print("point", point)
+        cond = self.computer.evaluate_constraints(self.problem, point)
+        return (cond, point)
+
+    def model_features(self, points):   # points are dictionaries in the original space
+
+        if (self.models_func is None):   # bound once per surrogate problem, the driver module itself is imported once per process
+            if(self.problem.driverabspath is not None):
+                self.models_func = import_driver(self.problem.driverabspath).models
+            else:
+                raise Exception('performance models require passing driverabspath to GPTune')
+        # modeldata= self.problem.models(point)
+        if (self.options is not None and self.options['model_features_vectorized']):   # one call with the tuning parameters as 1D arrays
+            columns = dict(points[0])
+            for k in range(self.problem.DP):
+                columns[self.problem.PS[k].name] = np.array([point[self.problem.PS[k].name] for point in points])
+            return np.array(self.models_func(columns)).reshape((len(points), -1))
+        return np.array([self.models_func(point) for point in points], ndmin=2)
 
     def fitness(self, x):   # x is the normalized space
         xi0 = self.problem.PS.inverse_transform(np.array(x, ndmin=2))
         xi=xi0[0]
 
-        if (any(xx==xi for xx in self.POrig)):
-            cond = False
-        else:
-            point0 = self.D
-            point2 = {self.problem.IS[k].name: self.IOrig[k] for k in range(self.problem.DI)}
-            point  = {self.problem.PS[k].name: xi[k] for k in range(self.problem.DP)}
-            point.update(point0)
-            point.update(point2)
-            # print("point", point)
-            cond = self.computer.evaluate_constraints(self.problem, point)
+        (cond, point) = self.check(xi)
 
         if (cond):
             xNorm = self.problem.PS.transform(xi0)[0]
             if(self.problem.models is not None):
-                if(self.problem.driverabspath is not None):
-                    modulename = Path(self.problem.driverabspath).stem  # get the driver name excluding all directories and extensions
-                    sys.path.append(self.problem.driverabspath) # add path to sys
-                    module = importlib.import_module(modulename) # import driver name as a module
-                else:
-                    raise Exception('performance models require passing driverabspath to GPTune')
-                # modeldata= self.problem.models(point)
-                modeldata= module.models(point)
+                modeldata= self.model_features([point])[0]
                 xNorm = np.hstack((xNorm,modeldata))  # YL: here tmpdata in the normalized space, but modeldata is the in the original space
                 # print(xNorm)
 
@@ -165,6 +393,34 @@ class SurrogateProblem(object):
             # print("cond",cond,float("Inf"),'x',x,'xi',xi)
             return [float("Inf")]* self.problem.DO
 
+    def batch_fitness(self, dvs):   # dvs is the concatenation of the decision vectors of a whole population, in the normalized space
+
+        X = np.array(dvs).reshape((-1, self.problem.DP))
+        xi0 = self.problem.PS.inverse_transform(X)
+
+        fs = np.full((X.shape[0], self.problem.DO), float("Inf"))
+        new = np.nonzero(np.logical_not(self.duplicates(xi0)))[0].tolist()
+        if (len(new) > 0):   # the constraints are checked on all the new points at once
+            columns = {self.problem.PS[k].name: CompiledConstraints.column([xi0[i][k] for i in new]) for k in range(self.problem.DP)}
+            columns.update(self.D)
+            columns.update({self.problem.IS[k].name: self.IOrig[k] for k in range(self.problem.DI)})
+            cond = self.computer.evaluate_constraints_batch(self.problem, columns, len(new))
+            idx = [new[j] for j in np.nonzero(cond)[0]]
+            if (len(idx) > 0):
+                xNorm = np.array(self.problem.PS.transform([xi0[i] for i in idx]), ndmin=2)
+                if(self.problem.models is not None):
+                    points = [self.point(xi0[i]) for i in idx]
+                    if(self.problem.constants is not None):
+                        for point in points:
+                            point.update(self.problem.constants)
+                    xNorm = np.hstack((xNorm, self.model_features(points)))
+                fs[idx,:] = self.ei_batch(xNorm)
+
+        return fs.flatten()
+
+    def has_batch_fitness(self):
+        return True
+
 import pygmo as pg
 
 class SearchPyGMO(Search):
@@ -175,11 +431,53 @@ class SearchPyGMO(Search):
     """
     # YL: TBB works also on AMD processors
 
+    def select_pareto(self, xs, fs, q, method):   # xs are candidates in the normalized space and fs their fitness, one column per objective
+
+        """
+        Pick q distinct feasible candidates by non-dominated sorting: whole fronts are taken in order, and the front that does not fit is truncated by crowding distance ('crowding') or by repeatedly dropping its least hypervolume contributor ('hypervolume').
+        'first' keeps the first q feasible rows, as the population is returned by the algorithm.
+        """
+        feasible = np.nonzero(np.all(fs < float('Inf'), axis=1))[0]
+        keys = set()
+        idx = []
+        for j in feasible:
+            key = tuple(self.problem.PS.inverse_transform(np.array(xs[j], ndmin=2))[0])
+            if (key not in keys):
+                keys.add(key)
+                idx.append(j)
+        idx = np.array(idx, dtype=int)
+        if (len(idx) <= q or method == 'first'):
+            return xs[idx[0:q]]
+
+        fs = fs[idx]
+        (ndf, _, _, _) = pg.fast_non_dominated_sorting(fs)
+        selected = []
+        for front in ndf:
+            front = np.array(front, dtype=int)
+            needed = q - len(selected)
+            if (needed <= 0):
+                break
+            if (len(front) > needed):
+                if (method == 'hypervolume'):
+                    ref = np.max(fs, axis=0) + 0.1 * (np.max(fs, axis=0) - np.min(fs, axis=0)) + 1e-12   # slightly beyond the nadir of the candidates, so that every candidate contributes
+                    front = list(front)
+                    while (len(front) > needed):
+                        del front[pg.hypervolume(fs[front]).least_contributor(ref)]
+                    front = np.array(front, dtype=int)
+                elif (method == 'crowding'):
+                    front = front[np.argsort(-pg.crowding_distance(fs[front]), kind='stable')[0:needed]]
+                else:
+                    raise Exception(f'Unknown multi-objective selection "{method}"')
+            selected.extend(front)
+
+        return xs[idx[selected]]
+
     def search(self, data : Data, models : Collection[Model], tid : int, **kwargs) -> np.ndarray:
 
         kwargs = kwargs['kwargs']
 
-        prob = SurrogateProblem(self.problem, self.computer, data, models, tid)
+        prob = SurrogateProblem(self.problem, self.computer, data, models, tid, options = kwargs)
+        population = None
 
         try:
             udi = eval(f'pg.{kwargs["search_udi"]}()')
@@ -187,39 +485,88 @@ class SearchPyGMO(Search):
             raise Exception('Unknown user-defined-island "{kwargs["search_udi"]}"')
 
 
+        warm = self.populations.get(tid) if kwargs['search_warm_start'] else None
+        if (warm is not None and kwargs['search_warm_start_gen'] is not None):   # the previous populations are already close to the optimum of the slightly updated surrogate
+            gen_warm = kwargs['search_warm_start_gen']
+        else:
+            gen_warm = kwargs['search_gen']
+
         if(self.problem.DO==1): # single objective
-            try:
-                algo = eval(f'pg.{kwargs["search_algo"]}(gen = kwargs["search_gen"])')
-            except:
-                raise Exception(f'Unknown optimization algorithm "{kwargs["search_algo"]}"')
+            def make_algo(gen):
+                try:
+                    algo = eval(f'pg.{kwargs["search_algo"]}(gen = gen)')
+                except:
+                    raise Exception(f'Unknown optimization algorithm "{kwargs["search_algo"]}"')
+                if (kwargs['search_batch_fitness'] and hasattr(algo, 'set_bfe')):   # e.g. pso_gen, the generational variant of pso, supports batch evaluations
+                    algo.set_bfe(pg.bfe())
+                return algo
             bestX = []
             cond = False
             cpt = 0
+            archi = None   # no archipelago if search_max_iters is 0
             while (not cond and cpt < kwargs['search_max_iters']):
-                archi = pg.archipelago(n = kwargs['search_threads'], prob = prob, algo = algo, udi = udi, pop_size = kwargs['search_pop_size'])
+                if (warm is not None and cpt == 0):   # each island starts from its share of the previous final populations, re-evaluated on the updated surrogate
+                    algo = make_algo(gen_warm)
+                    archi = pg.archipelago()
+                    for warm_isl in np.array_split(warm, kwargs['search_threads']):
+                        nwarm = min(len(warm_isl), kwargs['search_pop_size'])
+                        if (kwargs['search_batch_fitness']):
+                            pop = pg.population(prob = prob, size = kwargs['search_pop_size'] - nwarm, b = pg.bfe())
+                        else:
+                            pop = pg.population(prob = prob, size = kwargs['search_pop_size'] - nwarm)
+                        for x in warm_isl[0:nwarm]:
+                            pop.push_back(x)
+                        archi.push_back(udi = udi, algo = algo, pop = pop)
+                else:
+                    algo = make_algo(kwargs['search_gen'])
+                    if (kwargs['search_batch_fitness']):   # the initial populations of the islands are evaluated with one batch_fitness call each
+                        archi = pg.archipelago(n = kwargs['search_threads'], prob = prob, algo = algo, udi = udi, pop_size = kwargs['search_pop_size'], b = pg.bfe())
+                    else:
+                        archi = pg.archipelago(n = kwargs['search_threads'], prob = prob, algo = algo, udi = udi, pop_size = kwargs['search_pop_size'])
                 archi.evolve(n = kwargs['search_evolve'])
                 archi.wait()
                 champions_f = archi.get_champions_f()
                 champions_x = archi.get_champions_x()
                 indexes = list(range(len(champions_f)))
                 indexes.sort(key=champions_f.__getitem__)
-                for idx in indexes:
-                    if (champions_f[idx] < float('Inf')):
-                        cond = True
-                        # bestX.append(np.array(self.problem.PS.inverse_transform(np.array(champions_x[idx], ndmin=2))[0]).reshape(1, self.problem.DP))
-                        bestX.append(np.array(champions_x[idx]).reshape(1, self.problem.DP))
-                        break
+                if (kwargs['search_batch_size'] > 1 and champions_f[indexes[0]] < float('Inf')):   # q points from the final populations of all the islands
+                    cond = True
+                    xs = np.vstack([np.array(champions_x)] + [isl.get_population().get_x() for isl in archi])
+                    fs = np.concatenate([np.array(champions_f).flatten()] + [isl.get_population().get_f().flatten() for isl in archi])
+                    bestX.append(self.select_batch(xs, fs, kwargs['search_batch_size'], kwargs['search_batch_radius']))
+                else:
+                    for idx in indexes:
+                        if (champions_f[idx] < float('Inf')):
+                            cond = True
+                            # bestX.append(np.array(self.problem.PS.inverse_transform(np.array(champions_x[idx], ndmin=2))[0]).reshape(1, self.problem.DP))
+                            bestX.append(np.array(champions_x[idx]).reshape(1, self.problem.DP))
+                            break
                 cpt += 1
+            if (kwargs['search_warm_start'] and archi is not None):
+                population = np.vstack([isl.get_population().get_x() for isl in archi])
         else:                   # multi objective
-            try:
-                algo = eval(f'pg.algorithm(pg.{kwargs["search_algo"]}(gen = kwargs["search_gen"]))')
-            except:
-                raise Exception(f'Unknown optimization algorithm "{kwargs["search_algo"]}"')
+            def make_algo(gen):
+                try:
+                    uda = eval(f'pg.{kwargs["search_algo"]}(gen = gen)')
+                except:
+                    raise Exception(f'Unknown optimization algorithm "{kwargs["search_algo"]}"')
+                if (kwargs['search_batch_fitness'] and hasattr(uda, 'set_bfe')):   # e.g. nsga2 evaluates its offspring in batches
+                    uda.set_bfe(pg.bfe())
+                return pg.algorithm(uda)
             bestX = []
             cond = False
             cpt = 0
+            pop = None   # no population if search_max_iters is 0
             while (not cond and cpt < kwargs['search_max_iters']):
-                pop = pg.population(prob = prob, size = kwargs['search_pop_size'], seed = cpt+1)
+                nwarm = 0 if (warm is None or cpt > 0) else min(len(warm), kwargs['search_pop_size'])
+                algo = make_algo(gen_warm if nwarm > 0 else kwargs['search_gen'])
+                if (kwargs['search_batch_fitness']):
+                    pop = pg.population(prob = prob, size = kwargs['search_pop_size'] - nwarm, b = pg.bfe(), seed = cpt+1)
+                else:
+                    pop = pg.population(prob = prob, size = kwargs['search_pop_size'] - nwarm, seed = cpt+1)
+                if (nwarm > 0):   # the previous population, re-evaluated on the updated surrogate
+                    for x in warm[0:nwarm]:
+                        pop.push_back(x)
                 pop = algo.evolve(pop)
 
 
@@ -236,20 +583,83 @@ class SearchPyGMO(Search):
                 # fss = fs[bestidx]
                 # # print('bestidx',bestidx)
 
-                firstn = min(int(kwargs['search_more_samples']),np.shape(pop.get_f())[0])
-                fss = pop.get_f()[0:firstn]
-                xss = pop.get_x()[0:firstn]
-                # print('firstn',firstn,int(kwargs['search_more_samples']),np.shape(pop.get_f()),xss)
+                xss = self.select_pareto(pop.get_x(), pop.get_f(), int(kwargs['search_more_samples']), kwargs['search_mo_selection'])
+                # print('xss',int(kwargs['search_more_samples']),np.shape(pop.get_f()),xss)
 
 
-                if(np.max(fss)< float('Inf')):
+                if(len(xss) > 0):
                     cond = True
                     bestX.append(xss)
                     break
                 cpt += 1
+            if (kwargs['search_warm_start'] and pop is not None):
+                population = pop.get_x()
         if (kwargs['verbose']):
             print(tid, 'OK' if cond else 'KO'); sys.stdout.flush()
         # print("bestX",bestX)
+        if (population is not None):   # kept by search_multitask to seed the next search of this task
+            return (tid, bestX, population)
+        return (tid, bestX)
+
+class SearchLBFGS(Search):
+
+    """
+    Multi-start L-BFGS-B on the EI of single-objective problems.
+    The search_lbfgs_starts best of search_lbfgs_candidates random points (according to batch_fitness, so constraints and duplicates included) are optimized together as one separable bound-constrained problem, so that every function evaluation is a single batched model prediction.
+    The gradients are analytic for models providing predict_batch_gradient (Model_LCM, without performance models), and computed by forward finite differences in one batched prediction otherwise.
+    The optimized points, and the starting points as fallback, are then checked with batch_fitness.
+    """
+
+    def search(self, data : Data, models : Collection[Model], tid : int, **kwargs) -> np.ndarray:
+
+        kwargs = kwargs['kwargs']
+
+        if(self.problem.DO > 1):
+            raise Exception('SearchLBFGS only supports single-objective problems, use SearchPyGMO instead')
+
+        prob = SurrogateProblem(self.problem, self.computer, data, models, tid, options = kwargs)
+        DP = self.problem.DP
+        analytic = self.problem.models is None and all(hasattr(model, 'predict_batch_gradient') for model in models)
+        h = 1e-6
+
+        bestX = []
+        cond = False
+        cpt = 0
+        while (not cond and cpt < kwargs['search_max_iters']):
+            X0 = np.random.rand(kwargs['search_lbfgs_candidates'], DP)
+            f0 = prob.batch_fitness(X0.flatten())
+            starts = [i for i in np.argsort(f0)[0:kwargs['search_lbfgs_starts']] if f0[i] < float('Inf')]
+            if (len(starts) > 0):
+                X0 = X0[starts]
+                S = len(starts)
+
+                def fun(x):
+                    X = x.reshape((S, DP))
+                    if (analytic):
+                        (EI, dEI) = prob.ei_gradient(X)
+                        return (np.sum(EI[:,0]), dEI[:,0,:].flatten())
+                    steps = [np.where(X[:,d] + h <= 1, h, -h) for d in range(DP)]
+                    Xd = [X]
+                    for d in range(DP):
+                        Xtmp = X.copy()
+                        Xtmp[:,d] += steps[d]
+                        Xd.append(Xtmp)
+                    EI = prob.ei_relaxed(np.vstack(Xd))[:,0].reshape((DP + 1, S))
+                    dEI = np.array([(EI[d + 1] - EI[0]) / steps[d] for d in range(DP)]).T
+                    return (np.sum(EI[0]), dEI.flatten())
+
+                sol = scipy.optimize.minimize(fun, X0.flatten(), method='L-BFGS-B', jac=True, bounds=[(0., 1.)] * (S * DP), options={'maxiter': kwargs['search_lbfgs_max_iters']})
+                X1 = np.vstack((sol.x.reshape((S, DP)), X0))
+                f1 = prob.batch_fitness(X1.flatten())
+                if (np.min(f1) < float('Inf')):
+                    cond = True
+                    if (kwargs['search_batch_size'] > 1):
+                        bestX.append(self.select_batch(X1, f1, kwargs['search_batch_size'], kwargs['search_batch_radius']))
+                    else:
+                        bestX.append(X1[np.argmin(f1)].reshape(1, DP))
+            cpt += 1
+        if (kwargs['verbose']):
+            print(tid, 'OK' if cond else 'KO'); sys.stdout.flush()
         return (tid, bestX)
 
 if __name__ == '__main__':
@@ -285,10 +695,46 @@ if __name__ == '__main__':
     mpi_comm = MPI.Comm.Get_parent()
     mpi_rank = mpi_comm.Get_rank()
     mpi_size = mpi_comm.Get_size()
-    (searcher, data, models, tids, kwargs) = mpi_comm.bcast(None, root=0)
-    tids_loc = tids[mpi_rank:len(tids):mpi_size]
-    tmpdata = searcher.search_multitask(data, models, tids_loc, i_am_manager = False, **kwargs)
-    res = mpi_comm.gather(tmpdata, root=0)
+
+    cond = True
+    while (cond):
+
+        (cmd, payload) = mpi_comm.bcast(None, root=0)
+
+        if (cmd == "once" or cmd == "full"):
+
+            (searcher, data, models, kwargs) = payload
+
+        elif (cmd == "delta"):   # SearchWorkerPool: append the new samples and rebuild the predictors from the hyperparameters
+
+            (Pnew, Onew, training, hyperparameters, populations, kwargs) = payload
+            searcher.populations = populations
+            data.P = [np.concatenate((data.P[i], Pnew[i])) for i in range(len(data.P))]
+            data.O = [np.concatenate((data.O[i], Onew[i])) for i in range(len(data.O))]
+            for (model, (Ptrain, Otrain), x) in zip(models, training, hyperparameters):
+                tmpdata = data.view()   # the training data of the model: its objective column of O, with the performance model features appended to P
+                tmpdata.P = [np.concatenate((model.P_train[i], Ptrain[i])) for i in range(len(Ptrain))]
+                tmpdata.O = [np.concatenate((model.O_train[i], Otrain[i])) for i in range(len(Otrain))]
+                if (not kwargs['model_sparse'] and np.array_equal(model.M.kern.get_param_array(), x)):
+                    model.update(tmpdata, do_train = False, **kwargs)   # extends the Cholesky factor with the new samples
+                else:
+                    model.gen_model_from_hyperparameters(tmpdata, x, **kwargs)
+
+        elif (cmd == "end"):
+
+            cond = False
+            break
+
+        work_dynamic(mpi_comm, lambda tid: searcher.search_multitask(data, models, [tid], i_am_manager = False, **kwargs))
+
+        if (cmd == "once"):
+            cond = False
+        else:
+            # the group stays alive in SearchWorkerPool; wait for the next search without busy-polling the cores used by the other phases
+            req = mpi_comm.Ibarrier()
+            while (not req.Test()):
+                time.sleep(0.01)
+
     mpi_comm.Disconnect()
 
 
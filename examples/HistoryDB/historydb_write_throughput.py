@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+
+# GPTune Copyright (c) 2019, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S.Dept. of Energy) and the University of
+# California, Berkeley.  All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at IPO@lbl.gov.
+#
+# NOTICE. This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights.
+# As such, the U.S. Government has been granted for itself and others acting
+# on its behalf a paid-up, nonexclusive, irrevocable, worldwide license in
+# the Software to reproduce, distribute copies to the public, prepare
+# derivative works, and perform publicly and display publicly, and to permit
+# other to do so.
+#
+
+
+################################################################################
+import sys
+import os
+sys.path.insert(0, os.path.abspath(__file__ + "/../../../GPTune/"))
+
+from historydb import HistoryDB
+
+import argparse
+import json
+import multiprocessing
+import time
+import uuid
+
+"""
+Example of invocation of this script:
+
+python ./historydb_write_throughput.py -writers 4 -batches 100 -batchsize 1 -sync fcntl -appendlog 1
+
+where:
+    -writers is the number of concurrent processes appending to the history database
+    -batches is the number of appends of each process
+    -batchsize is the number of records of each append
+    -sync is the file_synchronization_method of the history database ('fcntl', 'filelock' or 'exclusive')
+    -appendlog is whether the records are appended to the .jsonl log instead of rewriting the json file
+"""
+
+################################################################################
+
+def throughput_writer(history_db_path, file_synchronization_method, append_log, num_batches, batch_size):
+
+    history_db = HistoryDB()
+    history_db.history_db_path = history_db_path
+    history_db.file_synchronization_method = file_synchronization_method
+    history_db.append_log = append_log
+    json_data_path = os.path.join(history_db_path, "throughput.json")
+    for i in range(num_batches):
+        records = [{"task_parameter":{"t":i}, "tuning_parameter":{"x":j}, "evaluation_result":{"y":float(j)}, "uid":str(uuid.uuid1())} for j in range(batch_size)]
+        history_db._append_records(json_data_path, {"func_eval": records})
+
+def measure_write_throughput(history_db_path, num_writers = 4, num_batches = 100, batch_size = 1, file_synchronization_method = 'fcntl', append_log = True):
+
+    """ Number of records per second appended to a scratch database (throughput.json in history_db_path) by num_writers concurrent processes, and the number of records lost """
+
+    os.makedirs(history_db_path, exist_ok=True)
+    json_data_path = os.path.join(history_db_path, "throughput.json")
+    for path in (json_data_path, json_data_path + "l"):
+        if os.path.exists(path):
+            os.remove(path)
+    with open(json_data_path, "w") as f_out:
+        json.dump({"tuning_problem_name":"throughput", "model_data":[], "func_eval":[]}, f_out)
+
+    writers = [multiprocessing.Process(target=throughput_writer, args=(history_db_path, file_synchronization_method, append_log, num_batches, batch_size)) for i in range(num_writers)]
+    t1 = time.time_ns()
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    t2 = time.time_ns()
+
+    history_db = HistoryDB()
+    history_db.history_db_path = history_db_path
+    history_db.file_synchronization_method = file_synchronization_method
+    num_records = num_writers*num_batches*batch_size
+    num_written = len(set(item["uid"] for item in history_db._load_history_data(json_data_path)["func_eval"]))
+
+    return (num_records/((t2-t1)/1e9), num_records-num_written)
+
+def parse_args():
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-path', type=str, default='./throughput.db', help='Directory of the scratch history database')
+    parser.add_argument('-writers', type=int, default=4, help='Number of concurrent writer processes')
+    parser.add_argument('-batches', type=int, default=100, help='Number of appends per writer')
+    parser.add_argument('-batchsize', type=int, default=1, help='Number of records per append')
+    parser.add_argument('-sync', type=str, default='fcntl', help='File synchronization method')
+    parser.add_argument('-appendlog', type=int, default=1, help='Whether to append to the .jsonl log')
+
+    args = parser.parse_args()
+
+    return args
+
+def main():
+
+    args = parse_args()
+    (throughput, lost) = measure_write_throughput(args.path, num_writers = args.writers, num_batches = args.batches, batch_size = args.batchsize, file_synchronization_method = args.sync, append_log = bool(args.appendlog))
+    print("records per second: ", throughput)
+    print("records lost: ", lost)
+
+if __name__ == "__main__":
+    main()
@@ -104,6 +104,84 @@ void K
     return;
 }
 
+void K_cross
+(
+    // Dimensions / Sizes
+    const int DI,  // dimension of tuning parameter space
+    const int NT,  // #of tasks
+    const int NL,  // #of latent functions in LCM
+    const int m,   // #of prediction points
+    const int n,   // #of training samples
+    // Input arrays
+    const double* restrict const theta, // size DI*NL, length scales for each Gaussian kernel k_q
+    const double* restrict const var,   // size NL, variance for each Gaussian kernel k_q
+    const double* restrict const BS,    // parameter matrices of size NT*NT of for each kernel k_q
+    const double* restrict const X1,    // size m*(DI+1), row major, the last column is the task index
+    const double* restrict const X2,    // size n*(DI+1), row major, the last column is the task index
+    // Output array
+    double* restrict C                  // size m*n, row major, C[i*n + j] = k(X1[i], X2[j])
+)
+{
+    int i, j, d, q, idxi, idxj;
+    double delta, sum, c;
+
+# pragma omp parallel for collapse(2) private ( i, j, d, q, idxi, idxj, delta, sum, c ) shared ( C )
+    for (i = 0; i < m; i++)
+    {
+        for (j = 0; j < n; j++)
+        {
+            idxi = (int) X1[i * (DI + 1) + DI];
+            idxj = (int) X2[j * (DI + 1) + DI];
+
+            c = 0.;
+            for (q = 0; q < NL; q++)
+            {
+                sum = 0.;
+                for (d = 0; d < DI; d++)
+                {
+                    delta = (X1[i * (DI + 1) + d] - X2[j * (DI + 1) + d]) / theta[q * DI + d];
+                    sum += delta * delta;
+                }
+                c += BS[(q * NT + idxi) * NT + idxj] * var[q] * exp( - sum / 2);
+            }
+            C[i*n + j] = c;
+        }
+    }
+    return;
+}
+
+void K_diag
+(
+    // Dimensions / Sizes
+    const int DI,  // dimension of tuning parameter space
+    const int NT,  // #of tasks
+    const int NL,  // #of latent functions in LCM
+    const int m,   // #of prediction points
+    // Input arrays
+    const double* restrict const var,   // size NL, variance for each Gaussian kernel k_q
+    const double* restrict const BS,    // parameter matrices of size NT*NT of for each kernel k_q
+    const double* restrict const X1,    // size m*(DI+1), row major, the last column is the task index
+    // Output array
+    double* restrict D                  // size m, D[i] = k(X1[i], X1[i]) = sum_q B_q[t_i, t_i] var_q
+)
+{
+    int i, q, idxi;
+    double c;
+
+# pragma omp parallel for private ( i, q, idxi, c ) shared ( D )
+    for (i = 0; i < m; i++)
+    {
+        idxi = (int) X1[i * (DI + 1) + DI];
+        c = 0.;
+        for (q = 0; q < NL; q++)
+        {
+            c += BS[(q * NT + idxi) * NT + idxi] * var[q];
+        }
+        D[i] = c;
+    }
+    return;
+}
+
 void rl2g(fun_jac_struct* z, int li, int prowid, int* gi)
 {
     *gi = z->mb * z->nprow * (li / z->mb) + z->mb * prowid + (li % z->mb);
@@ -95,6 +95,39 @@ typedef struct
 
 /* LCM routines */
 
+void K_cross // cross-covariance k(X1, X2) with row-major inputs, used for predictions
+(
+    // Dimensions / Sizes
+    const int DI,
+    const int NT,
+    const int NL,
+    const int m,
+    const int n,
+    // Input arrays
+    const double* restrict const theta,
+    const double* restrict const var,
+    const double* restrict const BS,
+    const double* restrict const X1,
+    const double* restrict const X2,
+    // Output array
+    double* restrict C
+);
+
+void K_diag // diagonal k(X1[i], X1[i]) with row-major inputs, used for predictions
+(
+    // Dimensions / Sizes
+    const int DI,
+    const int NT,
+    const int NL,
+    const int m,
+    // Input arrays
+    const double* restrict const var,
+    const double* restrict const BS,
+    const double* restrict const X1,
+    // Output array
+    double* restrict D
+);
+
 fun_jac_struct* initialize
 (
     // Dimensions / Sizes
@@ -0,0 +1,103 @@
+#! /usr/bin/env python3
+
+# GPTune Copyright (c) 2019, The Regents of the University of California,
+# through Lawrence Berkeley National Laboratory (subject to receipt of any
+# required approvals from the U.S.Dept. of Energy) and the University of
+# California, Berkeley.  All rights reserved.
+#
+# If you have questions about your rights to use or distribute this software,
+# please contact Berkeley Lab's Intellectual Property Office at IPO@lbl.gov.
+#
+# NOTICE. This Software was developed under funding from the U.S. Department
+# of Energy and the U.S. Government consequently retains certain rights.
+# As such, the U.S. Government has been granted for itself and others acting
+# on its behalf a paid-up, nonexclusive, irrevocable, worldwide license in
+# the Software to reproduce, distribute copies to the public, prepare
+# derivative works, and perform publicly and display publicly, and to permit
+# other to do so.
+#
+
+"""
+Warm-started Model_LCM training: restart 0 must start L-BFGS from the previous optimum.
+
+The LCM worker group is replaced by a fake intercommunicator returning a zero likelihood and gradient, so that L-BFGS stops after evaluating its starting point.
+
+Run with: python -m unittest discover tests
+"""
+
+import os
+import sys
+import types
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(__file__ + "/../../GPTune/"))
+
+
+class FakeComm(object):
+
+    def __init__(self, nparams):
+
+        self.nparams = nparams
+        self.points = []   # hyperparameters of every "fun_jac" request
+
+    def bcast(self, msg, root=None):
+
+        if (msg[0] == "fun_jac"):
+            self.points.append(np.copy(msg[1]))
+
+    def recv(self, source=None, tag=None):
+
+        return (0., np.zeros(self.nparams))
+
+
+class FakePool(object):
+
+    def __init__(self, comm):
+
+        self.comm = comm
+
+    def acquire(self, config, kwargs):
+
+        return self.comm
+
+    def release(self, config, mpi_comm, compute_time = 0):
+
+        pass
+
+
+class TestLCMWarmStart(unittest.TestCase):
+
+    def test_restart_0_starts_from_previous_optimum(self):
+
+        try:
+            from model import Model_LCM
+            from lcm import LCM
+        except (ImportError, OSError) as inst:   # GPy, mpi4py or the compiled LCM library are missing
+            self.skipTest(str(inst))
+
+        # theta (Q*DI), var (Q), kappa (Q*NI), sigma (NI), WS (Q*NI) with Q = NI = 1 and DI = 2, inside the L-BFGS bounds, var != 1
+        xprev = np.array([0.3, 2.5, 4.0, 0.2, 1e-6, 0.7])
+        kern = LCM(input_dim = 2, num_outputs = 1, Q = 1)
+        kern.set_param_array(xprev)
+
+        computer = types.SimpleNamespace(cores = 1)
+        model = Model_LCM(problem = None, computer = computer)
+        model.M = types.SimpleNamespace(kern = kern)
+        comm = FakeComm(len(xprev))
+        model.lcm_pool = FakePool(comm)
+
+        data = types.SimpleNamespace(P = [np.array([[0.1, 0.2], [0.5, 0.7], [0.9, 0.4]])], O = [np.array([[1.], [2.], [3.]])], NI = 1)
+        kwargs = {'RCI_mode': False, 'model_latent': None, 'model_warm_start': True, 'model_warm_start_perturbation': 0.1, 'model_warm_start_max_iters': 10, 'model_warm_start_ftol': 1e-6,
+                  'model_sparse': False, 'model_incremental': False, 'model_threads': 1, 'model_processes': 1, 'model_max_jitter_try': 10, 'verbose': False,
+                  'distributed_memory_parallelism': False, 'shared_memory_parallelism': False}
+
+        (xopt, fopt, gradients, iteration) = model.train_mpi(data, i_am_manager = True, restart_iters = [0], **kwargs)
+
+        np.testing.assert_allclose(comm.points[0], xprev, rtol = 1e-12)
+        np.testing.assert_allclose(xopt, xprev, rtol = 1e-12)
+
+
+if __name__ == '__main__':
+    unittest.main()